@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+import pymongo
+from pymongo import monitoring
+
+from concertron import settings
+
+# One MongoClient (and so one connection pool) per process, shared by the crawler, the web app and the Discord bot.
+# Everything is configured in concertron/settings.py and can be overridden with environment variables of the same name.
+
+def get_setting(name, default=None):
+    value = os.environ.get(name)
+    if value is None:
+        return getattr(settings, name, default)
+    if value.isdigit():
+        return int(value)
+    return value
+
+class PoolStats(monitoring.ConnectionPoolListener): # Keeps count of what the connection pool is doing so it can be sized under load
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                    'open': self.open,
+                    'checked_out': self.checked_out,
+                    'max_checked_out': self.max_checked_out,
+                    'checkouts': self.checkouts,
+                    'checkout_failures': self.checkout_failures,
+                    'wait_avg_ms': self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                    'wait_max_ms': self.wait_max * 1000,
+                    }
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        wait = time.monotonic() - getattr(self.local, 'started', time.monotonic())
+        with self.lock:
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open -= 1
+
+    # Not needed for the numbers above, but the listener interface requires them
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+pool_stats = PoolStats()
+clients = {}
+clients_lock = threading.Lock()
+
+def get_client(uri=None):
+    uri = uri or get_setting('MONGODB_URI')
+    with clients_lock:
+        if uri not in clients:
+            clients[uri] = pymongo.MongoClient(
+                    uri,
+                    maxPoolSize=get_setting('MONGODB_MAX_POOL_SIZE', 100),
+                    minPoolSize=get_setting('MONGODB_MIN_POOL_SIZE', 0),
+                    connectTimeoutMS=get_setting('MONGODB_CONNECT_TIMEOUT_MS', 20000),
+                    serverSelectionTimeoutMS=get_setting('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 30000),
+                    waitQueueTimeoutMS=get_setting('MONGODB_WAIT_QUEUE_TIMEOUT_MS'),
+                    readPreference=get_setting('MONGODB_READ_PREFERENCE', 'primary'),
+                    event_listeners=[pool_stats],
+                    )
+        return clients[uri]
+
+def get_db(name=None, uri=None):
+    return get_client(uri)[name or get_setting('MONGODB_DATABASE')]
+
+def close_clients(): # Only for when the process is done with MongoDB altogether
+    with clients_lock:
+        for client in clients.values():
+            client.close()
+        clients.clear()
+
+# Indexes for the query shapes used by the crawler, web app and bot. ensure_indexes() is run by all three on startup,
+# create_index is a no-op for indexes that already exist.
+indexes = {
+        get_setting('MONGODB_COLLECTION', 'events'): [
+            # Web app pages (keyset on date, _id), /filter and bot find_events: an event_type $in sorted by date. With _id in the
+            # index the $in branches are merged in order instead of sorted in memory
+            [('event_type', 1), ('date', 1), ('_id', 1)],
+            [('date', 1)], # clean_up
+            [('last_modified', 1), ('_id', 1)], # Bot update feed polling, see discord/feed.py
+            [('venue_id', 1)], # EventIndex.load_venue when a spider opens
+            ],
+        'discord_users': [
+            [('artists', 1)], # create_sendlist $in's
+            [('tags', 1)],
+            [('events', 1)],
+            ],
+        get_setting('CONDITIONAL_COLLECTION', 'http_cache'): [
+            [('venue_id', 1)], # ConcertronConditionalMiddleware.load
+            [('checked', 1)], # clean_up
+            ],
+        get_setting('IMAGES_CACHE_COLLECTION', 'images'): [
+            [('events', 1)], # Image cache eviction
+            ],
+        get_setting('ARTISTS_COLLECTION', 'artists'): [
+            [('tokens', 1)], # Prefix search, see concertron/search.py
+            [('events', 1)], # Removing past events
+            ],
+        }
+
+def ensure_indexes(db=None):
+    db = db if db is not None else get_db()
+    created = []
+    for collection, keys_list in indexes.items():
+        for keys in keys_list:
+            created.append(f"{collection}.{db[collection].create_index(keys)}")
+    return created
+
+def plan_stages(plan): # All stage names in a (nested) winning plan
+    stages = [plan.get('stage')]
+    for child in plan.get('inputStages', []) + [plan[key] for key in ('inputStage', 'queryPlan') if key in plan]:
+        stages.extend(plan_stages(child))
+    return stages
+
+def collscan_report(db=None): # Explains the query shapes above and returns the ones that still scan a whole collection or sort in memory
+    db = db if db is not None else get_db()
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    event_types = {'event_type': {'$in': ['Club', 'Concert', 'Festival']}}
+    shapes = {
+            'web app index': (get_setting('MONGODB_COLLECTION', 'events'), {**event_types, 'date': {'$gte': today}}, [('date', 1), ('_id', 1)]), # See webapp/app.py fetch_page
+            'bot feed polling': (get_setting('MONGODB_COLLECTION', 'events'), {'last_modified': {'$gt': today, '$lte': datetime.now()}}, [('last_modified', 1), ('_id', 1)]),
+            'clean_up': (get_setting('MONGODB_COLLECTION', 'events'), {'date': {'$lt': today - timedelta(days=1)}}, None),
+            'load_venue': (get_setting('MONGODB_COLLECTION', 'events'), {'venue_id': ''}, None),
+            'create_sendlist': ('discord_users', {'$or': [{'artists': {'$in': ['']}}, {'tags': {'$in': ['']}}, {'events': {'$in': ['']}}]}, None),
+            'conditional load': (get_setting('CONDITIONAL_COLLECTION', 'http_cache'), {'venue_id': ''}, None),
+            'image eviction': (get_setting('IMAGES_CACHE_COLLECTION', 'images'), {'events': {'$in': ['']}}, None),
+            'artist search': (get_setting('ARTISTS_COLLECTION', 'artists'), {'$and': [{'tokens': {'$regex': '^a'}}]}, None),
+            }
+    scans = {}
+    for name, (collection, filter, sort) in shapes.items():
+        cursor = db[collection].find(filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        if 'COLLSCAN' in stages or 'SORT' in stages: # SORT is the blocking one, SORT_MERGE over index branches is fine
+            scans[name] = stages
+    return scans
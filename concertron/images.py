@@ -0,0 +1,140 @@
+from PIL import Image, ImageOps
+import hashlib
+import math
+import os
+import shutil
+import threading
+import time
+import warnings
+
+# Image work that runs in the image process pool (see ImageEncodePipeline). Keep this module free of Scrapy and Twisted
+# imports, every worker process imports it.
+
+def crop_box(width, height, target_aspect_ratio=1.47): # Centered crop to the aspect ratio used everywhere (web app, Discord embeds)
+    original_aspect_ratio = width / height
+    if original_aspect_ratio <= target_aspect_ratio:
+        target_height = int(width / target_aspect_ratio)
+        height_diff = (height - target_height) // 2
+        return (0, height_diff, width, height - height_diff)
+    else:
+        target_width = int(height / (1/target_aspect_ratio))
+        width_diff = (width - target_width) // 2
+        return (width_diff, 0, width - width_diff, height)
+
+def save_webp(img, destination, quality=80, method=4):
+    # Per process and thread: two image workers, or two web app threads making the same size, can write the same picture at once
+    temporary = f"{destination}.{os.getpid()}-{threading.get_ident()}.tmp"
+    img.save(temporary, format="WEBP", quality=quality, method=method)
+    os.replace(temporary, destination) # Never leave a half written file where a lookup can find it
+
+def resize_to_width(img, width):
+    if img.width <= width:
+        return img
+    return img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+
+def size_path(directory, name, size): # Derivative of {name}.webp with one of the IMAGES_SIZES widths
+    return os.path.join(directory, 'sizes', size, name + '.webp')
+
+def open_checked(source, max_pixels=None): # Only reads the header. Refuses anything over the pixel budget before a single pixel is decoded
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', Image.DecompressionBombWarning) # Pillow only warns for the first 2x over its own limit
+        img = Image.open(source)
+    if max_pixels and img.width * img.height > max_pixels:
+        img.close()
+        raise Image.DecompressionBombError(f"{img.width}x{img.height} is over the budget of {max_pixels} pixels")
+    return img
+
+def decode_reduced(img, target_aspect_ratio=1.47, max_width=None):
+    # Decodes no more than needed for a crop of at most max_width wide: JPEG DCT scaling (draft) where possible, reduce() otherwise
+    width, height = img.size
+    if img.getexif().get(0x0112) in (5, 6, 7, 8): # Rotated by 90 degrees, the crop is done on the upright image
+        width, height = height, width
+    box = crop_box(width, height, target_aspect_ratio)
+    scale = max_width / (box[2] - box[0]) if max_width else 1
+    if scale < 1 and img.format == 'JPEG':
+        img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale))) # Picks the smallest 1/2, 1/4 or 1/8 scale at least this big
+    img = ImageOps.exif_transpose(img)
+    if scale < 1:
+        box = crop_box(*img.size, target_aspect_ratio)
+        factor = (box[2] - box[0]) // max_width # Whatever draft left over, without going under max_width
+        if factor >= 2:
+            img = img.reduce(factor)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    return img
+
+def crop_to_webp(source, destination, target_aspect_ratio=1.47, quality=80, method=4, sizes=None, max_width=None, max_pixels=None):
+    # Crops and saves the full WEBP (at most max_width wide) and, from the same decoded image, the smaller derivatives in
+    # sizes ({destination: width}). Returns the time it took, for the stats.
+    start = time.monotonic()
+    with open_checked(source, max_pixels) as img:
+        reduced = decode_reduced(img, target_aspect_ratio, max_width)
+        new = reduced.crop(crop_box(*reduced.size, target_aspect_ratio))
+        if max_width:
+            new = resize_to_width(new, max_width)
+        save_webp(new, destination, quality, method)
+        for size_destination, width in (sizes or {}).items():
+            os.makedirs(os.path.dirname(size_destination), exist_ok=True)
+            save_webp(resize_to_width(new, width), size_destination, quality, method)
+    return time.monotonic() - start
+
+def resize_webp(source, destination, width, quality=80, method=4): # For derivatives that are missing, made from the full WEBP
+    with Image.open(source) as img:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        save_webp(resize_to_width(img, width), destination, quality, method)
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_paths(cache_dir, digest): # Raw download and cropped WEBP of one image in the content-addressed cache
+    return os.path.join(cache_dir, 'raw', digest + '.jpg'), os.path.join(cache_dir, 'webp', digest + '.webp')
+
+def place(source, destination): # Hard link where possible, the cache and img/ are normally on the same disk
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def place_all(cache_dir, digest, output_dir, _id, sizes=None): # Puts the cached full WEBP and any cached derivatives in place for one event
+    place(cache_paths(cache_dir, digest)[1], os.path.join(output_dir, _id + '.webp'))
+    for size in sizes or {}:
+        cached = size_path(cache_dir, digest, size)
+        if os.path.exists(cached): # Missing ones are made on request by the web app
+            os.makedirs(os.path.dirname(size_path(output_dir, _id, size)), exist_ok=True)
+            place(cached, size_path(output_dir, _id, size))
+
+def cache_and_encode(source, cache_dir, output_dir, _id, target_aspect_ratio=1.47, quality=80, method=4, sizes=None, max_width=None, max_pixels=None):
+    # Stores the download in the cache under its content hash and only crops/encodes if that content was never seen before.
+    # Returns the hash and the encode time (0 if the cached WEBP was used).
+    digest = file_hash(source)
+    raw, webp = cache_paths(cache_dir, digest)
+    os.makedirs(os.path.dirname(raw), exist_ok=True)
+    os.makedirs(os.path.dirname(webp), exist_ok=True)
+    if not os.path.exists(raw):
+        shutil.copyfile(source, raw)
+    encode_time = 0.0
+    if not os.path.exists(webp):
+        derivatives = {size_path(cache_dir, digest, size): width for size, width in (sizes or {}).items()}
+        encode_time = crop_to_webp(raw, webp, target_aspect_ratio, quality, method, derivatives, max_width, max_pixels)
+    place_all(cache_dir, digest, output_dir, _id, sizes)
+    return digest, encode_time
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def evict(db, collection, cache_dir, event_ids, sizes=None): # Drops cache entries only used by the given (deleted) events, files included
+    db[collection].update_many({'events': {'$in': event_ids}}, {'$pull': {'events': {'$in': event_ids}}})
+    orphans = list(db[collection].find({'events': {'$size': 0}}, {'hash': 1}))
+    in_use = set(db[collection].distinct('hash', {'events': {'$ne': []}}))
+    for orphan in orphans:
+        if orphan.get('hash') not in in_use:
+            remove_files(list(cache_paths(cache_dir, orphan['hash'])) + [size_path(cache_dir, orphan['hash'], size) for size in sizes or {}])
+    db[collection].delete_many({'_id': {'$in': [orphan['_id'] for orphan in orphans]}})
@@ -22,6 +22,7 @@ class ConcertronNewItem(scrapy.Item):
     last_check = scrapy.Field()
     last_modified = scrapy.Field()
     updates = scrapy.Field()
+    agenda_digest = scrapy.Field()
 
 class ConcertronUpdatedItem(scrapy.Item):
     _id = scrapy.Field()
@@ -35,6 +36,7 @@ class ConcertronUpdatedItem(scrapy.Item):
     status = scrapy.Field()
     last_check = scrapy.Field()
     updates = scrapy.Field()
+    agenda_digest = scrapy.Field()
 
 class ConcertronTagsItem(scrapy.Item):
     _id = scrapy.Field()
@@ -4,8 +4,14 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 import scrapy
+from scrapy.exceptions import IgnoreRequest, NotConfigured
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
+from datetime import datetime
+import hashlib
+import pymongo
+from concertron.db import get_db
+from concertron.utils import defer_to_mongo
 
 
 class ConcertronSpiderMiddleware:
@@ -116,3 +122,84 @@ class ConcertronDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class NotModified(IgnoreRequest): # Raised for detail pages that did not change since the last check. Ends up in the request's errback
+    pass
+
+
+class ConcertronConditionalMiddleware:
+    # Conditional requests for detail pages. Keeps ETag, Last-Modified and a hash of the body per URL in MongoDB, sends
+    # If-None-Match/If-Modified-Since and drops pages that turn out unchanged, so they never reach parse_updated.
+    # Only requests with meta['conditional'] set are checked, spiders handle the NotModified in their errback. Requests with
+    # meta['store_validators'] (new events) only have their validators stored, for the next time the page is checked.
+
+    def __init__(self, collection_name, stats):
+        self.collection_name = collection_name
+        self.stats = stats
+        self.validators = {}
+        self.pending = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CONDITIONAL_ENABLED', True):
+            raise NotConfigured
+        s = cls(crawler.settings.get('CONDITIONAL_COLLECTION', 'http_cache'), crawler.stats)
+        crawler.signals.connect(s.spider_opened, signal=scrapy.signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=scrapy.signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        return defer_to_mongo(self.load, getattr(spider, 'venue_id', spider.name))
+
+    def load(self, venue_id):
+        for entry in get_db()[self.collection_name].find({'venue_id': venue_id}):
+            self.validators[entry['_id']] = entry
+
+    def spider_closed(self, spider):
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            return defer_to_mongo(self.store, pending)
+
+    def store(self, pending):
+        get_db()[self.collection_name].bulk_write([pymongo.UpdateOne({'_id': url}, {'$set': entry}, upsert=True) for url, entry in pending.items()], ordered=False)
+
+    def process_request(self, request, spider):
+        entry = self.validators.get(request.url)
+        if request.meta.get('conditional') and entry:
+            if entry.get('etag'):
+                request.headers.setdefault('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.headers.setdefault('If-Modified-Since', entry['last_modified'])
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('conditional') and not request.meta.get('store_validators'):
+            return response
+
+        entry = self.validators.get(request.url) if request.meta.get('conditional') else None
+        if entry:
+            self.stats.inc_value('conditional/requests')
+        if response.status == 304 and entry:
+            self.stats.inc_value('conditional/not_modified')
+            self.stats.inc_value('conditional/requests_saved')
+            self.stats.inc_value('conditional/bytes_saved', entry.get('length', 0))
+            raise NotModified(f"Not modified: {request.url}")
+
+        if response.status == 200:
+            digest = hashlib.sha1(response.body).hexdigest()
+            new_entry = {
+                    'venue_id': getattr(spider, 'venue_id', spider.name),
+                    'etag': response.headers.get('ETag', b'').decode('latin-1') or None,
+                    'last_modified': response.headers.get('Last-Modified', b'').decode('latin-1') or None,
+                    'hash': digest,
+                    'length': len(response.body),
+                    'checked': datetime.now(),
+                    }
+            self.validators[request.url] = new_entry
+            self.pending[request.url] = new_entry
+            if entry and entry.get('hash') == digest: # Server does not do conditional requests, but the page is the same
+                self.stats.inc_value('conditional/unchanged')
+                self.stats.inc_value('conditional/requests_saved')
+                raise NotModified(f"Unchanged: {request.url}")
+        return response
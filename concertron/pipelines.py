@@ -7,18 +7,123 @@
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 import pymongo
+from pymongo.errors import BulkWriteError, PyMongoError
 from datetime import datetime
 import os
-from PIL import Image
+import time
 from concertron.items import ConcertronNewItem, ConcertronUpdatedItem, ConcertronTagsItem, ImageItem
-from scrapy.pipelines.images import ImagesPipeline
+from concertron.utils import event_index, image_cache, relevant_fields, defer_to_mongo, defer_to_process
+from concertron.images import cache_and_encode, open_checked, place_all
+from concertron.db import get_db, pool_stats
+from concertron import search
+from scrapy.pipelines.images import ImageException, ImagesPipeline
+from io import BytesIO
+from PIL import Image
+from twisted.internet import defer, task
 import scrapy
 
+def each(value): # Values of an $addToSet, with or without $each
+    if isinstance(value, dict) and '$each' in value:
+        return list(value['$each'])
+    return [value]
+
+class BulkWriter: # Write-behind buffer. Collects inserts and updates and sends them with unordered bulk_write once the buffer is big or old enough
+    def __init__(self, db, size, interval, stats=None, logger=None):
+        self.db = db
+        self.size = size
+        self.interval = interval
+        self.stats = stats
+        self.logger = logger
+        self.inserts = {} # (collection, _id): document
+        self.updates = {} # (collection, _id): update document
+        self.upserts = set() # Keys in updates that should create the document if it is not there
+        self.last_flush = time.monotonic()
+        self.lock = defer.DeferredLock() # One flush at a time, so a later batch can never overtake an earlier one
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates)
+
+    def insert(self, collection, document):
+        self.inserts[(collection, document['_id'])] = document
+
+    def update(self, collection, _id, update, upsert=False):
+        # Writes to the same document are merged, so the order of operations within an unordered batch does not matter
+        key = (collection, _id)
+        if key in self.inserts and list(update.keys()) == ['$set']:
+            self.inserts[key].update(update['$set']) # Not written yet, just fold it into the document
+        else:
+            pending = self.updates.setdefault(key, {})
+            for operator, fields in update.items():
+                target = pending.setdefault(operator, {})
+                for field, value in fields.items():
+                    if operator == '$addToSet' and field in target: # Two $addToSet's on one field become one $each
+                        values = each(target[field])
+                        target[field] = {'$each': values + [v for v in each(value) if v not in values]}
+                    else:
+                        target[field] = value
+            if upsert:
+                self.upserts.add(key)
+
+    def flush_if_due(self): # Returns a Deferred if a flush was started, None otherwise
+        if len(self) >= self.size or (len(self) and time.monotonic() - self.last_flush >= self.interval):
+            return self.flush()
+
+    def flush(self): # Buffers are swapped on the reactor thread, the actual writing happens in the MongoDB thread pool
+        inserts, self.inserts = self.inserts, {}
+        updates, self.updates = self.updates, {}
+        upserts, self.upserts = self.upserts, set()
+        self.last_flush = time.monotonic()
+        d = self.lock.run(defer_to_mongo, self.write, inserts, updates, upserts)
+        d.addCallback(self.record)
+        return d
+
+    def write(self, inserts, updates, upserts=()):
+        results = []
+        # Inserts go first so that updates never hit a document that does not exist yet
+        for ops in (inserts, updates):
+            batches = {}
+            for (collection, _id), op in ops.items():
+                if ops is inserts:
+                    batches.setdefault(collection, []).append(pymongo.InsertOne(op))
+                else:
+                    batches.setdefault(collection, []).append(pymongo.UpdateOne({'_id': _id}, op, upsert=(collection, _id) in upserts))
+            for collection, batch in batches.items():
+                results.append(self.write_batch(collection, batch))
+        return results
+
+    def write_batch(self, collection, batch):
+        errors = []
+        start = time.monotonic()
+        try:
+            self.db[collection].bulk_write(batch, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', []) + e.details.get('writeConcernErrors', [])
+        except PyMongoError as e: # AutoReconnect, timeouts and the like: nothing in the batch can be assumed written
+            errors = [{'errmsg': repr(e)}] * len(batch)
+        return collection, len(batch), errors, time.monotonic() - start
+
+    def record(self, results): # Back on the reactor thread
+        for collection, size, errors, latency in results:
+            if self.stats:
+                self.stats.inc_value('mongodb/bulk_batches')
+                self.stats.inc_value('mongodb/bulk_operations', size)
+                self.stats.inc_value('mongodb/bulk_errors', len(errors))
+                self.stats.inc_value('mongodb/bulk_latency_total', latency)
+                self.stats.max_value('mongodb/bulk_latency_max', latency)
+            if self.logger:
+                if errors:
+                    self.logger.error(f"Bulk write to {collection} had {len(errors)} errors: {errors[:5]}")
+                self.logger.debug(f"Flushed {size} operations to {collection} in {latency * 1000:.1f} ms ({len(errors)} errors)")
+
 class ConcertronPipeline:
-    def __init__(self, mongo_uri, mongo_db, collection_name):
+    def __init__(self, mongo_uri, mongo_db, collection_name, write_behind=True, bulk_size=500, bulk_interval=5, stats=None):
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
         self.collection_name = collection_name
+        self.write_behind = write_behind
+        self.bulk_size = bulk_size
+        self.bulk_interval = bulk_interval
+        self.stats = stats
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -26,36 +131,73 @@ class ConcertronPipeline:
             mongo_uri=crawler.settings.get('MONGODB_URI'),
             mongo_db=crawler.settings.get('MONGODB_DATABASE'),
             collection_name=crawler.settings.get('MONGODB_COLLECTION'),
+            write_behind=crawler.settings.getbool('MONGODB_WRITE_BEHIND', True),
+            bulk_size=crawler.settings.getint('MONGODB_BULK_SIZE', 500),
+            bulk_interval=crawler.settings.getfloat('MONGODB_BULK_INTERVAL', 5),
+            stats=crawler.stats,
         )
 
     def open_spider(self, spider):
-        self.client = pymongo.MongoClient(self.mongo_uri)
-        self.db = self.client[self.mongo_db]
+        self.db = get_db(self.mongo_db, self.mongo_uri) # Shared client, so no new connection pool per spider
+        # Without write-behind every operation is flushed right away
+        self.writer = BulkWriter(self.db, self.bulk_size if self.write_behind else 1, self.bulk_interval, stats=self.stats, logger=spider.logger)
+        self.flusher = task.LoopingCall(self.flush_due) # Makes sure the time threshold also applies when items stop coming in
+        if self.write_behind:
+            self.flusher.start(self.bulk_interval, now=False)
+        # The spider only starts once this Deferred fires, so the event index is complete before the first agenda is parsed
+        return defer_to_mongo(event_index.load_venue, getattr(spider, 'venue_id', spider.name)) # Spiders without a venue_id use their name as venue_id
+
+    def flush_due(self): # A failed flush must not errback into the LoopingCall, that would stop it for good
+        d = self.writer.flush_if_due()
+        if d:
+            d.addErrback(lambda failure: self.writer.logger.error(f"Flush failed: {failure.getErrorMessage()}"))
+        return d
 
     def close_spider(self, spider):
-        self.client.close()
+        if self.flusher.running:
+            self.flusher.stop()
+        d = self.writer.flush()
+        d.addBoth(self.record_pool_stats)
+        return d
+
+    def record_pool_stats(self, result):
+        if self.stats:
+            for key, value in pool_stats.snapshot().items():
+                self.stats.set_value(f'mongodb/pool/{key}', value)
+        return result
 
     def process_item(self, item, spider):
+        # All comparisons happen in memory against the event index. MongoDB is only touched by flushes, which run in the
+        # MongoDB thread pool. While one runs, the item waits for it, so CONCURRENT_ITEMS is what limits the backlog.
         if isinstance(item, ConcertronNewItem):
-            return self.process_new(item, spider)
+            result = self.process_new(item, spider)
         elif isinstance(item, ConcertronUpdatedItem):
-            return self.process_update(item, spider)
+            result = self.process_update(item, spider)
         elif isinstance(item, ConcertronTagsItem):
-            return self.process_tags(item, spider)
+            result = self.process_tags(item, spider)
         else:
             return item
 
+        flushing = self.writer.flush_if_due()
+        if flushing:
+            return flushing.addCallback(lambda _: result)
+        return result
+
     def process_new(self, item, spider):
         entry = item
         entry['updates'] ='new'
-        self.db[self.collection_name].insert_one(dict(entry))
+        self.writer.insert(self.collection_name, dict(entry))
+        event_index.update(entry['_id'], entry)
+        for name in entry.get('lineup') or []: # Lineups are only written on insert, so this is the only place the artist index changes
+            update = search.artist_update(name, entry['_id'])
+            if update:
+                self.writer.update(search.collection_name, update[0], update[1], upsert=True)
         return item
 
     def process_update(self, item, spider):
-        entry = self.db[self.collection_name].find_one({'_id': item.get('_id')})
+        entry = event_index.get(item.get('_id'))
 
-        # Compare relevant fields and check for changes
-        relevant_fields = ['title', 'subtitle', 'support', 'date', 'location', 'tags', 'status']  # Define relevant fields for comparison
+        # Compare relevant fields and check for changes. relevant_fields is defined in utils as the event index holds these
         # fields_changed = any(entry.get(field) != item.get(field) for field in relevant_fields)
         fields_changed = {field: item.get(field) for field in relevant_fields if item.get(field) and entry.get(field) != item.get(field)}
 
@@ -67,10 +209,22 @@ class ConcertronPipeline:
             if item.get('last_check'):
                 fields_changed['last_check'] = item.get('last_check')
             fields_changed['last_modified'] = datetime.now()
-            self.db[self.collection_name].update_one({'_id': item['_id']}, {'$set': fields_changed})
+            if item.get('agenda_digest'): # Not a change in itself, so not in updates
+                fields_changed['agenda_digest'] = item.get('agenda_digest')
+            self.writer.update(self.collection_name, item['_id'], {'$set': fields_changed})
+            event_index.update(item['_id'], fields_changed)
             return item
         elif item.get('last_check') and not fields_changed:
-            self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'last_check': item.get('last_check'), 'updates': []}})
+            unchanged = {'last_check': item.get('last_check'), 'updates': []}
+            if item.get('agenda_digest'):
+                unchanged['agenda_digest'] = item.get('agenda_digest')
+            self.writer.update(self.collection_name, item.get('_id'), {'$set': unchanged})
+            event_index.update(item.get('_id'), unchanged)
+            return None
+        elif item.get('agenda_digest') and item.get('agenda_digest') != entry.get('agenda_digest'):
+            # Nothing relevant changed, but remember the agenda row so it can be skipped next run
+            self.writer.update(self.collection_name, item.get('_id'), {'$set': {'agenda_digest': item.get('agenda_digest')}})
+            event_index.update(item.get('_id'), {'agenda_digest': item.get('agenda_digest')})
             return None
         else:
             # Skip processing if relevant fields have not changed and no deep check was done
@@ -84,30 +238,72 @@ class ConcertronPipeline:
         edge_cases_festival = ['Festivals']
         edge_cases_knowledge = ['Literature / Science / Politics / Art', 'Workshop', 'Panel', 'Talks', 'DJ & Producer Workshops']
 
-        entry = self.db[self.collection_name].find_one({'_id': item.get('_id')})
-        tags = entry.get('tags')
+        entry = event_index.get(item.get('_id'))
+        tags = list(entry.get('tags'))
         if item.get('tag') not in tags:
             tags.append(item.get('tag'))
+            event_index.update(item.get('_id'), {'tags': tags})
             if item.get('tag') in edge_cases_art:
-                self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'event_type': 'Art', 'tags': tags, 'last_modified': item.get('last_modified')}})
+                self.writer.update(self.collection_name, item.get('_id'), {'$set': {'event_type': 'Art', 'tags': tags, 'last_modified': item.get('last_modified')}})
             elif item.get('tag') in edge_cases_club:
-                self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'event_type': 'Club', 'tags': tags, 'last_modified': item.get('last_modified')}})
+                self.writer.update(self.collection_name, item.get('_id'), {'$set': {'event_type': 'Club', 'tags': tags, 'last_modified': item.get('last_modified')}})
             elif item.get('tag') in edge_cases_comedy:
-                self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'event_type': 'Comedy', 'tags': tags, 'last_modified': item.get('last_modified')}})
+                self.writer.update(self.collection_name, item.get('_id'), {'$set': {'event_type': 'Comedy', 'tags': tags, 'last_modified': item.get('last_modified')}})
             # elif item.get('tag') in edge_cases_concert:
-                # self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'event_type': 'Concert', 'tags': tags, 'last_modified': item.get('last_modified')}})
+                # self.writer.update(self.collection_name, item.get('_id'), {'$set': {'event_type': 'Concert', 'tags': tags, 'last_modified': item.get('last_modified')}})
             elif item.get('tag') in edge_cases_festival:
-                self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'event_type': 'Festival', 'tags': tags, 'last_modified': item.get('last_modified')}})
+                self.writer.update(self.collection_name, item.get('_id'), {'$set': {'event_type': 'Festival', 'tags': tags, 'last_modified': item.get('last_modified')}})
             elif item.get('tag') in edge_cases_knowledge:
-                self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'event_type': 'Knowledge', 'tags': tags, 'last_modified': item.get('last_modified')}})
+                self.writer.update(self.collection_name, item.get('_id'), {'$set': {'event_type': 'Knowledge', 'tags': tags, 'last_modified': item.get('last_modified')}})
             else:
-                self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'tags': tags, 'last_modified': item.get('last_modified')}})
-            # self.db[self.collection_name].update_one({'_id': item.get('_id')}, {'$set': {'tags': tags, 'last_modified': item.get('last_modified')}})
+                self.writer.update(self.collection_name, item.get('_id'), {'$set': {'tags': tags, 'last_modified': item.get('last_modified')}})
+            # self.writer.update(self.collection_name, item.get('_id'), {'$set': {'tags': tags, 'last_modified': item.get('last_modified')}})
             return item
         else:
             return None
 
+class ImageCachePipeline: # Runs before CustomImagePipeline. Images already in the cache are linked into place and never downloaded again
+    def __init__(self, output_dir, sizes, stats):
+        self.output_dir = output_dir
+        self.sizes = sizes
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            output_dir=crawler.settings.get('IMAGES_OUTPUT_DIR', 'img'),
+            sizes=crawler.settings.getdict('IMAGES_SIZES'),
+            stats=crawler.stats,
+        )
+
+    def open_spider(self, spider):
+        return defer_to_mongo(image_cache.load)
+
+    def close_spider(self, spider):
+        return defer_to_mongo(image_cache.flush)
+
+    def process_item(self, item, spider):
+        if not isinstance(item, ImageItem) or not item.get('image_urls'):
+            return item
+
+        url = item['image_urls'][0]
+        digest = image_cache.lookup(url)
+        if digest:
+            place_all(image_cache.cache_dir, digest, self.output_dir, item['_id'], self.sizes)
+            image_cache.add(url, digest, item['_id'])
+            item['image_urls'] = [] # Nothing left for CustomImagePipeline to download
+            self.stats.inc_value('images/cache_hits')
+        else:
+            self.stats.inc_value('images/cache_misses')
+        return item
+
 class CustomImagePipeline(ImagesPipeline):
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.max_pixels = crawler.settings.getint('IMAGES_MAX_PIXELS') or None
+        return pipeline
+
     def get_media_requests(self, item, info):
         if isinstance(item, ImageItem):
             for image_url in item["image_urls"]:
@@ -115,39 +311,77 @@ class CustomImagePipeline(ImagesPipeline):
         else:
             return item
 
-    def item_completed(self, results, item, info):
-        dir_base = './img/'
-        dir_dl = 'dl/'
+    def get_images(self, response, request, info, *, item=None):
+        # Stores the download as is. The default converts it to JPEG here, which decodes every image at full resolution on the
+        # reactor thread. Decoding (reduced) is left to ImageEncodePipeline, only the header is read to enforce the pixel budget.
+        path = self.file_path(request, response=response, info=info, item=item)
+        try:
+            image = open_checked(BytesIO(response.body), self.max_pixels)
+        except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            raise ImageException(str(e))
+        if image.width < self.min_width or image.height < self.min_height:
+            raise ImageException(f"Image too small ({image.width}x{image.height} < {self.min_width}x{self.min_height})")
+        yield path, image, BytesIO(response.body)
+
+    def item_completed(self, results, item, info): # Cropping and encoding is left to ImageEncodePipeline
         if isinstance(item, ImageItem):
-            image_paths = [x["path"] for ok, x in results if ok]
             adapter = ItemAdapter(item)
-            adapter["image_paths"] = image_paths
-            for image_path in adapter["image_paths"]:
-                with Image.open(dir_base + dir_dl + image_path) as img:
-                    target_aspect_ratio = 1.47
-                    original_width, original_height = img.size
-                    original_aspect_ratio = original_width / original_height
-                    if original_aspect_ratio <= target_aspect_ratio:
-                        target_height = int(original_width / target_aspect_ratio)
-                        height_diff = (original_height - target_height) // 2
-
-                        left = 0
-                        top = height_diff
-                        right = original_width
-                        bottom = original_height - height_diff
-                        coordinates = (left, top, right, bottom)
-                    else:
-                        target_width = int(original_height / (1/target_aspect_ratio))
-                        width_diff = (original_width - target_width ) // 2
-
-                        left = width_diff
-                        top = 0
-                        right = original_width - width_diff
-                        bottom = original_height
-                        coordinates = (left, top, right, bottom)
-                    new = img.crop(coordinates)
-                    new.save(str(dir_base + adapter['_id'] + '.webp'), format="WEBP")
-                    # os.remove(str(dir_base + dir_dl + image_path))
-                    return item
-        else:
+            adapter["image_paths"] = [x["path"] for ok, x in results if ok]
+        return item
+
+class ImageEncodePipeline: # Crops downloaded images and encodes them to WEBP (full size plus IMAGES_SIZES) in a process pool, so PIL never blocks the reactor
+    def __init__(self, images_store, output_dir, sizes, quality, method, max_width, max_pixels, stats):
+        self.images_store = images_store
+        self.output_dir = output_dir
+        self.sizes = sizes
+        self.max_width = max_width
+        self.max_pixels = max_pixels
+        self.quality = quality
+        self.method = method
+        self.stats = stats
+        self.queue_depth = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            images_store=crawler.settings.get('IMAGES_STORE'),
+            output_dir=crawler.settings.get('IMAGES_OUTPUT_DIR', 'img'),
+            sizes=crawler.settings.getdict('IMAGES_SIZES'),
+            quality=crawler.settings.getint('IMAGES_WEBP_QUALITY', 80),
+            method=crawler.settings.getint('IMAGES_WEBP_METHOD', 4),
+            max_width=crawler.settings.getint('IMAGES_MAX_WIDTH') or None,
+            max_pixels=crawler.settings.getint('IMAGES_MAX_PIXELS') or None,
+            stats=crawler.stats,
+        )
+
+    def process_item(self, item, spider):
+        if not isinstance(item, ImageItem) or not item.get('image_paths'):
             return item
+
+        source = os.path.join(self.images_store, item['image_paths'][0])
+        self.queue_depth += 1
+        self.stats.set_value('images/queue_depth', self.queue_depth)
+        self.stats.max_value('images/queue_depth_max', self.queue_depth)
+        d = defer_to_process(cache_and_encode, source, image_cache.cache_dir, self.output_dir, item['_id'], 1.47, self.quality, self.method, self.sizes, self.max_width, self.max_pixels)
+        d.addCallbacks(self.encoded, self.failed, callbackArgs=(item,), errbackArgs=(item, spider))
+        return d
+
+    def encoded(self, result, item):
+        digest, encode_time = result
+        self.queue_depth -= 1
+        self.stats.set_value('images/queue_depth', self.queue_depth)
+        image_cache.add(item['image_urls'][0], digest, item['_id'])
+        if not encode_time: # Different URL, same picture
+            self.stats.inc_value('images/cache_content_hits')
+            return item
+        self.stats.inc_value('images/encoded')
+        self.stats.inc_value('images/encode_time_total', encode_time)
+        self.stats.max_value('images/encode_time_max', encode_time)
+        return item
+
+    def failed(self, failure, item, spider):
+        self.queue_depth -= 1
+        self.stats.set_value('images/queue_depth', self.queue_depth)
+        self.stats.inc_value('images/encode_errors')
+        spider.logger.error(f"Could not encode image for {item['_id']}: {failure.value!r}")
+        return item
@@ -0,0 +1,109 @@
+import ast
+import importlib
+import importlib.util
+import json
+import os
+import pkgutil
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.project import get_project_settings
+
+# Spider registry. Knows every spider's name, module, venue_id and kind (events/tags) without importing the spider modules:
+# they are read with ast and the result is cached in memory and in a manifest file, which is rebuilt when a module changes.
+# Only the spiders that actually get run are imported.
+
+manifest = None
+
+def module_files(settings=None):
+    settings = settings or get_project_settings()
+    files = {}
+    for package in settings.getlist('SPIDER_MODULES'):
+        spec = importlib.util.find_spec(package)
+        for module in pkgutil.iter_modules(spec.submodule_search_locations):
+            if not module.ispkg:
+                files[f"{package}.{module.name}"] = os.path.join(module.module_finder.path, module.name + '.py')
+    return files
+
+def class_attribute(node, attribute):
+    for statement in node.body:
+        if isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Constant):
+            if any(isinstance(target, ast.Name) and target.id == attribute for target in statement.targets):
+                return statement.value.value
+    return None
+
+def scan_module(module_name, path):
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    spiders = []
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and any(ast.unparse(base).endswith('Spider') for base in node.bases):
+            name = class_attribute(node, 'name')
+            if name:
+                spiders.append({
+                    'name': name,
+                    'module': module_name,
+                    'class': node.name,
+                    'venue_id': class_attribute(node, 'venue_id') or name, # Spiders without a venue_id use their name as venue_id
+                    'kind': 'tags' if name.endswith('_tags') else 'events',
+                    })
+    return spiders
+
+def build_manifest(settings=None):
+    settings = settings or get_project_settings()
+    files = module_files(settings)
+    signature = {module: os.path.getmtime(path) for module, path in files.items()}
+    manifest_file = settings.get('SPIDER_MANIFEST_FILE')
+
+    if manifest_file and os.path.exists(manifest_file):
+        with open(manifest_file, encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get('signature') == signature:
+            return cached['spiders']
+
+    spiders = []
+    for module, path in sorted(files.items()):
+        spiders.extend(scan_module(module, path))
+    if manifest_file:
+        try:
+            os.makedirs(os.path.dirname(manifest_file) or '.', exist_ok=True)
+            with open(manifest_file, 'w', encoding='utf-8') as f:
+                json.dump({'signature': signature, 'spiders': spiders}, f, indent=2)
+        except OSError:
+            pass # The in-memory copy still works, it just has to be rebuilt next run
+    return spiders
+
+def get_manifest(settings=None):
+    global manifest
+    if manifest is None:
+        manifest = build_manifest(settings)
+    return manifest
+
+def find(venue_ids=None, kinds=None, names=None, settings=None):
+    return [entry for entry in get_manifest(settings)
+            if (not venue_ids or entry['venue_id'] in venue_ids)
+            and (not kinds or entry['kind'] in kinds)
+            and (not names or entry['name'] in names)]
+
+def load(entry):
+    return getattr(importlib.import_module(entry['module']), entry['class'])
+
+class RegistrySpiderLoader(SpiderLoader): # Drop-in for Scrapy's SpiderLoader that imports a spider module only when that spider is asked for
+    def __init__(self, settings):
+        self.settings = settings
+        super().__init__(settings)
+
+    def _load_all_spiders(self):
+        pass
+
+    def load(self, spider_name):
+        if spider_name not in self._spiders:
+            entries = find(names=[spider_name], settings=self.settings)
+            if not entries:
+                raise KeyError(f"Spider not found: {spider_name}")
+            self._spiders[spider_name] = load(entries[0])
+        return self._spiders[spider_name]
+
+    def list(self):
+        return [entry['name'] for entry in get_manifest(self.settings)]
+
+    def find_by_request(self, request):
+        return [name for name in self.list() if self.load(name).handles_request(request)]
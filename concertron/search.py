@@ -0,0 +1,53 @@
+import re
+import unicodedata
+import pymongo
+
+from concertron.db import get_setting
+
+# Artist search. Every act on a lineup gets a document in the artists collection:
+# {'_id': normalized name, 'name': name as first seen, 'tokens': [normalized words], 'events': [event ids]}
+# Queries are normalized the same way and every query word has to be the start of one of the tokens, which is an anchored
+# regex on an indexed field instead of a case-insensitive scan of every lineup. Used by the web app (/filter) and the bot ($artist).
+
+collection_name = get_setting('ARTISTS_COLLECTION', 'artists')
+
+def normalize(text): # Lowercase, accents folded (Beyoncé -> beyonce), punctuation to spaces
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    return ' '.join(re.sub(r'[\W_]+', ' ', text).split())
+
+def artist_update(name, _id): # Key and update document to add event _id to an artist, None for names that normalize to nothing
+    key = normalize(name or '')
+    if not key:
+        return None
+    return key, {'$setOnInsert': {'name': name.strip(), 'tokens': key.split()}, '$addToSet': {'events': _id}}
+
+def find_artists(db, query, limit=50):
+    tokens = normalize(query or '').split()
+    if not tokens:
+        return []
+    filter = {'$and': [{'tokens': {'$regex': '^' + re.escape(token)}} for token in tokens]}
+    return list(db[collection_name].find(filter, {'name': 1, 'events': 1}).limit(limit))
+
+def find_event_ids(db, query, limit=50): # Ids of the events with an artist matching the query, for an _id $in filter
+    event_ids = set()
+    for artist in find_artists(db, query, limit):
+        event_ids.update(artist.get('events', []))
+    return list(event_ids)
+
+def remove_events(db, event_ids): # For deleted events. Artists left without events go too
+    db[collection_name].update_many({'events': {'$in': event_ids}}, {'$pull': {'events': {'$in': event_ids}}})
+    db[collection_name].delete_many({'events': {'$size': 0}})
+
+def rebuild(db, events_collection='events'): # Backfill from the lineups already in the db, for a new install or after changing normalize()
+    artists = {}
+    for event in db[events_collection].find({'lineup': {'$exists': True}}, {'lineup': 1}):
+        for name in event.get('lineup') or []:
+            update = artist_update(name, event['_id'])
+            if update:
+                artist = artists.setdefault(update[0], {'_id': update[0], 'name': name.strip(), 'tokens': update[0].split(), 'events': []})
+                artist['events'].append(event['_id'])
+    db[collection_name].delete_many({})
+    if artists:
+        db[collection_name].bulk_write([pymongo.InsertOne(artist) for artist in artists.values()], ordered=False)
+    return len(artists)
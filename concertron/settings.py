@@ -11,6 +11,9 @@ BOT_NAME = "concertron"
 
 SPIDER_MODULES = ["concertron.spiders"]
 NEWSPIDER_MODULE = "concertron.spiders"
+# Spiders are looked up in a cached manifest, so only the spiders that run get imported
+SPIDER_LOADER_CLASS = "concertron.registry.RegistrySpiderLoader"
+SPIDER_MANIFEST_FILE = ".cache/spider_manifest.json"
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -19,15 +22,25 @@ NEWSPIDER_MODULE = "concertron.spiders"
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
+# Maximum number of items processed in parallel per response (default: 100). Also caps how many items can wait on a MongoDB flush
+CONCURRENT_ITEMS = 100
+
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 #CONCURRENT_REQUESTS = 32
 
+# Number of venues run_spiders.py crawls at the same time. Spiders of one venue always run one after the other
+CRAWL_MAX_PARALLEL = 6
+# Number of processes run_spiders.py spreads the venues over, each with its own reactor. 1 runs everything in-process
+CRAWL_PROCESSES = 1
+CRAWL_SHARD_TIMEOUT = 10800 # Seconds the parent waits for a shard's results
+
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
 #DOWNLOAD_DELAY = 3
 # The download delay setting will honor only one of:
-#CONCURRENT_REQUESTS_PER_DOMAIN = 16
+# With venues crawled in parallel this is what keeps each site from getting hammered
+CONCURRENT_REQUESTS_PER_DOMAIN = 8
 #CONCURRENT_REQUESTS_PER_IP = 16
 
 # Disable cookies (enabled by default)
@@ -52,8 +65,13 @@ ROBOTSTXT_OBEY = True
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
    "concertron.middlewares.ConcertronDownloaderMiddleware": 543,
+   "concertron.middlewares.ConcertronConditionalMiddleware": 580, # Below HttpCompressionMiddleware (590) so it hashes the decoded body
 }
 
+# Conditional requests for detail pages (see ConcertronConditionalMiddleware)
+CONDITIONAL_ENABLED = True
+CONDITIONAL_COLLECTION = 'http_cache'
+
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
@@ -64,7 +82,9 @@ DOWNLOADER_MIDDLEWARES = {
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
    "concertron.pipelines.ConcertronPipeline": 100,
+   "concertron.pipelines.ImageCachePipeline": 150,
    "concertron.pipelines.CustomImagePipeline": 200,
+   "concertron.pipelines.ImageEncodePipeline": 300,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -99,7 +119,58 @@ MONGODB_DATABASE = 'concertron'
 # MONGODB_COLLECTION = 'events'
 MONGODB_COLLECTION = 'events'
 MONGODB_INDEX_KEY = '_id'
+ARTISTS_COLLECTION = 'artists' # Artist search index, see concertron/search.py
+FACETS_TTL = 30 # Seconds the web app trusts its cached filter lists before checking their version, see webapp/facets.py
+# Connection pool of the shared client in concertron/db.py, used by the crawler, web app and Discord bot
+MONGODB_MAX_POOL_SIZE = 50
+MONGODB_MIN_POOL_SIZE = 0
+MONGODB_CONNECT_TIMEOUT_MS = 5000
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = 10000
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = 10000
+MONGODB_READ_PREFERENCE = 'primary'
+# Write-behind: item pipeline writes are buffered and sent with bulk_write when either threshold is hit, and on spider close
+MONGODB_WRITE_BEHIND = True
+MONGODB_BULK_SIZE = 500
+MONGODB_BULK_INTERVAL = 5 # Seconds
+# Blocking pymongo calls run in a thread pool of this size instead of on the reactor thread
+MONGODB_THREADPOOL_SIZE = 4
 
 LOG_FILE = 'logs/scrapy.log'
 
 IMAGES_STORE = 'img/dl'
+IMAGES_OUTPUT_DIR = 'img' # Where the cropped {_id}.webp files go
+# Smaller widths made from the same decode, in IMAGES_OUTPUT_DIR/sizes/{size}/{_id}.webp. The web app serves them with ?size=
+IMAGES_SIZES = {'thumb': 320, 'card': 640}
+# Limits for huge originals. Images are decoded at a reduced scale when they are wider than IMAGES_MAX_WIDTH after cropping
+# and refused (before decoding) when they have more than IMAGES_MAX_PIXELS pixels
+IMAGES_MAX_WIDTH = 1280
+IMAGES_MAX_PIXELS = 50000000
+# Cropping and WEBP encoding run in a process pool
+IMAGES_PROCESS_WORKERS = 2
+IMAGES_WEBP_QUALITY = 80
+IMAGES_WEBP_METHOD = 4 # 0 (fast) to 6 (small)
+# Content-addressed cache of downloads and their WEBPs, so an image is only downloaded and encoded once.
+# The collection maps image URLs to a hash and the events using it, run_spiders.py evicts entries no event uses anymore.
+IMAGES_CACHE_DIR = 'img/cache'
+IMAGES_CACHE_COLLECTION = 'images'
+
+# Discord bot, see discord/feed.py. Mode is auto (change stream if MongoDB is a replica set, polling otherwise), stream or poll
+DISCORD_FEED_MODE = 'auto'
+DISCORD_POLL_INTERVAL = 300 # Seconds
+DISCORD_FEED_SETTLE = 60 # Seconds an event has to be in the db before polling picks it up
+DISCORD_FEED_MAX_ATTEMPTS = 3 # Times sending an event may fail before the feed skips it
+DISCORD_MONGODB_WORKERS = 4 # Threads for the bot's database calls, see discord/executor.py
+# Notification queue, see discord/notify.py
+DISCORD_NOTIFY_CONCURRENCY = 8
+DISCORD_NOTIFY_QUEUE_SIZE = 1000
+DISCORD_ROUTE_RATE = 5 # Messages per DISCORD_ROUTE_PER seconds, per DM or channel
+DISCORD_ROUTE_PER = 5
+DISCORD_GLOBAL_RATE = 40 # Per second, Discord's global limit is 50
+DISCORD_NOTIFY_RETRIES = 3
+DISCORD_NOTIFY_BACKOFF = 1 # Seconds, doubled on every retry
+DISCORD_SUBSCRIPTIONS_TTL = 600 # Seconds before the bot rebuilds its follower index from discord_users, see discord/subscriptions.py
+# Digest mode sends each recipient one set of messages per cycle instead of one message per event, see discord/digest.py
+DISCORD_NOTIFY_MODE = 'each' # each or digest
+DISCORD_DIGEST_WINDOW = 300 # Seconds per cycle
+DISCORD_DIGEST_PER_MESSAGE = 10 # Embeds per message, 10 at most
+DISCORD_DIGEST_PER_CYCLE = 50 # Events per recipient per cycle, the rest is only counted
@@ -4,7 +4,8 @@ from datetime import datetime, timezone
 import json
 from html import unescape
 
-from concertron.utils import does_event_exist 
+from concertron.utils import classify_events, agenda_digest, agenda_unchanged
+from concertron.middlewares import NotModified
 
 class spiderEvents(scrapy.Spider):
     name = "nl_013_events"
@@ -58,6 +59,7 @@ class spiderEvents(scrapy.Spider):
                 return 'UNKNOWN' #Thusfar, nothing returns this
 
     def parse(self, response):
+        agenda = []
         for entry in response.xpath('//article'):
             show_url = entry.xpath('.//a/@href').get()
             show = entry.xpath('.//a')[0]
@@ -69,15 +71,22 @@ class spiderEvents(scrapy.Spider):
                     'date': datetime.fromisoformat(show.xpath('.//time/@datetime').get()).astimezone(timezone.utc).replace(tzinfo=None),
                     'status': self.check_status(show, response.url),
             }
-
-            event_status = does_event_exist(main_data.get('_id'))
+            main_data['agenda_digest'] = agenda_digest(main_data) # Fingerprint of the agenda row, compared against the one stored last run
+            agenda.append((show_url, main_data))
+
+        statuses = classify_events([main_data['_id'] for show_url, main_data in agenda]) # One db round trip for the whole agenda page
+        for show_url, main_data in agenda:
+            event_status = statuses.get(main_data.get('_id'))
+            if event_status == 'EVENT_EXISTS' and agenda_unchanged(main_data): # Same agenda row as last run and no deep check due, nothing to do
+                self.crawler.stats.inc_value('agenda/unchanged')
+                continue
             if event_status == 'EVENT_DOES_NOT_EXIST':
-                yield scrapy.Request(url=show_url, callback=self.parse_new, meta={'main_data': main_data})
+                yield scrapy.Request(url=show_url, callback=self.parse_new, meta={'main_data': main_data, 'store_validators': True})
             elif event_status == "EVENT_EXISTS":
                 event_item = ConcertronUpdatedItem(**main_data)
                 yield event_item
             elif event_status == "EVENT_UPDATE":
-                yield scrapy.Request(url=show_url, callback=self.parse_updated, meta={'main_data': main_data})
+                yield scrapy.Request(url=show_url, callback=self.parse_updated, errback=self.parse_unchanged, meta={'main_data': main_data, 'conditional': True})
 
     def parse_new(self, response):
         main_data = response.meta['main_data']
@@ -131,6 +140,15 @@ class spiderEvents(scrapy.Spider):
         event_item = ConcertronUpdatedItem(**main_data)
         yield event_item
 
+    def parse_unchanged(self, failure): # Detail page is the same as last time, so only the agenda data and last_check are processed
+        if failure.check(NotModified):
+            main_data = failure.request.meta['main_data']
+            main_data['last_check'] = datetime.now()
+            event_item = ConcertronUpdatedItem(**main_data)
+            yield event_item
+        else:
+            self.logger.error(repr(failure))
+
 
 class spiderTags(scrapy.Spider):
     name = "nl_013_tags"
@@ -1,7 +1,7 @@
 import scrapy
 from concertron.items import ConcertronNewItem, ConcertronUpdatedItem, ImageItem
 from datetime import datetime, timezone
-from concertron.utils import does_event_exist
+from concertron.utils import classify_events, agenda_digest, agenda_unchanged
 import json
 
 class spider(scrapy.Spider):
@@ -56,6 +56,7 @@ class spider(scrapy.Spider):
                 matches.append(query)
         if len(matches) == 1:
             agenda = matches[0]['state']['data']['pageData']['algolia']['serverState']['initialResults']['production_events']['results'][0]['hits']
+        rows = []
         for show in agenda: 
             subtitle, support = self.split_subtitle(show.get('subtitle'))
             main_data = { 
@@ -68,7 +69,15 @@ class spider(scrapy.Spider):
                     'tags': [genre['title'] for genre in show.get('genres')],
                     'status': self.check_status(show.get('state')),
                     }
-            event_status = does_event_exist(main_data.get('_id'))
+            main_data['agenda_digest'] = agenda_digest(main_data) # Fingerprint of the agenda row, compared against the one stored last run
+            rows.append((show, support, main_data))
+
+        statuses = classify_events([main_data['_id'] for show, support, main_data in rows]) # One db round trip for the whole agenda
+        for show, support, main_data in rows:
+            event_status = statuses.get(main_data.get('_id'))
+            if event_status == 'EVENT_EXISTS' and agenda_unchanged(main_data): # Same agenda row as last run and no deep check due, nothing to do
+                self.crawler.stats.inc_value('agenda/unchanged')
+                continue
             if event_status == 'EVENT_DOES_NOT_EXIST':
                 additional_data = {
                         'event_type': 'Comedy' if 'Popcultuur / Comedy / Film' in main_data.get('tags') else 'Concert',
@@ -1,7 +1,8 @@
 import scrapy
 from concertron.items import ConcertronNewItem, ConcertronUpdatedItem, ImageItem
 from datetime import datetime, timezone
-from concertron.utils import does_event_exist
+from concertron.utils import classify_events, agenda_digest, agenda_unchanged
+from concertron.middlewares import NotModified
 
 class spider(scrapy.Spider):
     name = "nl_melkweg"
@@ -63,6 +64,7 @@ class spider(scrapy.Spider):
             raise Exception('Page type is invalid!')
 
     def parse(self, response):
+        agenda = []
         for show in response.css("li.styles_event-list-day__list-item__o6KTp"):
             show_url = show.css('a ::attr(href)').get()
             subtitle = show.css('p.styles_event-compact__subtitle__yGojc ::text')
@@ -73,14 +75,22 @@ class spider(scrapy.Spider):
                     'tags': list(filter(lambda x: x != ' · ', show.css('p.styles_tags-list__DAdH2 ::text').extract())),
                     'status': self.check_status(show, 'agenda'),
                     }
-            event_status = does_event_exist(main_data.get('_id'))
+            main_data['agenda_digest'] = agenda_digest(main_data) # Fingerprint of the agenda row, compared against the one stored last run
+            agenda.append((show_url, main_data))
+
+        statuses = classify_events([main_data['_id'] for show_url, main_data in agenda]) # One db round trip for the whole agenda page
+        for show_url, main_data in agenda:
+            event_status = statuses.get(main_data.get('_id'))
+            if event_status == 'EVENT_EXISTS' and agenda_unchanged(main_data): # Same agenda row as last run and no deep check due, nothing to do
+                self.crawler.stats.inc_value('agenda/unchanged')
+                continue
             if event_status == 'EVENT_DOES_NOT_EXIST':
-                yield scrapy.Request(url=str('https://www.melkweg.nl' + show_url), callback=self.parse_new, meta={'main_data': main_data})
+                yield scrapy.Request(url=str('https://www.melkweg.nl' + show_url), callback=self.parse_new, meta={'main_data': main_data, 'store_validators': True})
             elif event_status == "EVENT_EXISTS":
                 event_item = ConcertronUpdatedItem(**main_data)
                 yield event_item
             elif event_status == "EVENT_UPDATE":
-                yield scrapy.Request(url=str('https://www.melkweg.nl' + show_url), callback=self.parse_updated, meta={'main_data': main_data})
+                yield scrapy.Request(url=str('https://www.melkweg.nl' + show_url), callback=self.parse_updated, errback=self.parse_unchanged, meta={'main_data': main_data, 'conditional': True})
 
     def parse_new(self, response):
         main_data = response.meta['main_data']
@@ -123,3 +133,12 @@ class spider(scrapy.Spider):
         main_data.update(additional_data)
         event_item = ConcertronUpdatedItem(**main_data)
         yield event_item
+
+    def parse_unchanged(self, failure): # Detail page is the same as last time, so only the agenda data and last_check are processed
+        if failure.check(NotModified):
+            main_data = failure.request.meta['main_data']
+            main_data['last_check'] = datetime.now()
+            event_item = ConcertronUpdatedItem(**main_data)
+            yield event_item
+        else:
+            self.logger.error(repr(failure))
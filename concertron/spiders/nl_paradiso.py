@@ -2,7 +2,7 @@ import scrapy
 from concertron.items import ConcertronNewItem, ConcertronUpdatedItem, ConcertronTagsItem, ImageItem
 import json
 from datetime import datetime, timezone
-from concertron.utils import does_event_exist
+from concertron.utils import classify_events, agenda_digest, agenda_unchanged
 
 
 class spiderEvents(scrapy.Spider):
@@ -30,6 +30,7 @@ class spiderEvents(scrapy.Spider):
         data = json.loads(response.body)
         agenda = data.get('data').get('program').get('events')
 
+        rows = []
         for show in agenda:
             main_data = {
                     '_id': str(self.venue_id + '-' + str(show.get('id'))),
@@ -43,8 +44,15 @@ class spiderEvents(scrapy.Spider):
                     'status': self.check_status(show), # Just for reference
                     }
             main_data['lineup'] = main_data['support'] + [main_data['title']]
+            main_data['agenda_digest'] = agenda_digest(main_data) # Fingerprint of the agenda row, compared against the one stored last run
+            rows.append((show, main_data))
 
-            event_status = does_event_exist(main_data.get('_id'))
+        statuses = classify_events([main_data['_id'] for show, main_data in rows]) # One db round trip for the whole agenda instead of one per event
+        for show, main_data in rows:
+            event_status = statuses.get(main_data.get('_id'))
+            if event_status == 'EVENT_EXISTS' and agenda_unchanged(main_data): # Same agenda row as last run and no deep check due, nothing to do
+                self.crawler.stats.inc_value('agenda/unchanged')
+                continue
             if event_status == 'EVENT_DOES_NOT_EXIST':
                 additional_data = {
                         'event_type': 'Concert',
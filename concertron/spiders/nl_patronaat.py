@@ -1,7 +1,8 @@
 import scrapy
 from concertron.items import ConcertronNewItem, ConcertronUpdatedItem, ImageItem
 from datetime import datetime, timezone
-from concertron.utils import does_event_exist, construct_datetime
+from concertron.utils import classify_events, agenda_digest, agenda_unchanged, construct_datetime
+from concertron.middlewares import NotModified
 
 class spider(scrapy.Spider):
     name = "nl_patronaat"
@@ -50,6 +51,7 @@ class spider(scrapy.Spider):
     def parse(self, response):
         if response.body:
             agenda = response.xpath("//div[@class='event-program']")
+            rows = []
             for show in agenda: 
                 title, support, status_hint = self.split_title(show.xpath(".//h3/a/text()").get().strip())
                 show_url = show.xpath(".//a/@href").get()
@@ -61,14 +63,22 @@ class spider(scrapy.Spider):
                         'tags': list(map(str.strip, show.xpath(".//a[@class='event__tags-item event__tags-item--genre']/text()").getall())),
                         'status': self.check_status(show, status_hint),
                         }
-                event_status = does_event_exist(main_data.get('_id'))
+                main_data['agenda_digest'] = agenda_digest(main_data) # Fingerprint of the agenda row, compared against the one stored last run
+                rows.append((show_url, main_data))
+
+            statuses = classify_events([main_data['_id'] for show_url, main_data in rows]) # One db round trip per loaded batch
+            for show_url, main_data in rows:
+                event_status = statuses.get(main_data.get('_id'))
+                if event_status == 'EVENT_EXISTS' and agenda_unchanged(main_data): # Same agenda row as last run and no deep check due, nothing to do
+                    self.crawler.stats.inc_value('agenda/unchanged')
+                    continue
                 if event_status == 'EVENT_DOES_NOT_EXIST':
-                    yield scrapy.Request(url=show_url, callback=self.parse_new, meta={'main_data': main_data})
+                    yield scrapy.Request(url=show_url, callback=self.parse_new, meta={'main_data': main_data, 'store_validators': True})
                 elif event_status == "EVENT_EXISTS":
                     event_item = ConcertronUpdatedItem(**main_data)
                     yield event_item
                 elif event_status == "EVENT_UPDATE":
-                    yield scrapy.Request(url=show_url, callback=self.parse_updated, meta={'main_data': main_data})
+                    yield scrapy.Request(url=show_url, callback=self.parse_updated, errback=self.parse_unchanged, meta={'main_data': main_data, 'conditional': True})
             if response.meta.get('counter'):
                 counter = response.meta.get('counter') + 1
             else:
@@ -126,3 +136,12 @@ class spider(scrapy.Spider):
 
         event_item = ConcertronUpdatedItem(**main_data)
         yield event_item
+
+    def parse_unchanged(self, failure): # Detail page is the same as last time, so only the agenda data and last_check are processed
+        if failure.check(NotModified):
+            main_data = failure.request.meta['main_data']
+            main_data['last_check'] = datetime.now()
+            event_item = ConcertronUpdatedItem(**main_data)
+            yield event_item
+        else:
+            self.logger.error(repr(failure))
@@ -1,7 +1,8 @@
 import scrapy
 from concertron.items import ConcertronNewItem, ConcertronUpdatedItem, ConcertronTagsItem, ImageItem
 from datetime import datetime, timezone
-from concertron.utils import does_event_exist, construct_datetime
+from concertron.utils import classify_events, agenda_digest, agenda_unchanged, construct_datetime
+from concertron.middlewares import NotModified
 
 
 class spiderEvents(scrapy.Spider):
@@ -100,6 +101,7 @@ class spiderEvents(scrapy.Spider):
             return separated[:-1] + last if len(separated) > 1 and ' & ' in separated[-1] else separated
 
     def parse(self, response):
+        agenda = []
         for show in response.css('li.agenda-list-item'):
             show_url = show.css('a.link ::attr(href)').get()
             main_data = {
@@ -108,14 +110,22 @@ class spiderEvents(scrapy.Spider):
                     'subtitle': str(' '.join(show.css('p.agenda-list-item__text ::text').getall()).strip()),
                     'status': self.check_status(show),
                     }
-            event_status = does_event_exist(main_data.get('_id'))
+            main_data['agenda_digest'] = agenda_digest(main_data) # Fingerprint of the agenda row, compared against the one stored last run
+            agenda.append((show_url, main_data))
+
+        statuses = classify_events([main_data['_id'] for show_url, main_data in agenda]) # One db round trip per agenda page
+        for show_url, main_data in agenda:
+            event_status = statuses.get(main_data.get('_id'))
+            if event_status == 'EVENT_EXISTS' and agenda_unchanged(main_data): # Same agenda row as last run and no deep check due, nothing to do
+                self.crawler.stats.inc_value('agenda/unchanged')
+                continue
             if event_status == 'EVENT_DOES_NOT_EXIST':
-                yield scrapy.Request(url=show_url, callback=self.parse_new, meta={'main_data': main_data})
+                yield scrapy.Request(url=show_url, callback=self.parse_new, meta={'main_data': main_data, 'store_validators': True})
             elif event_status == "EVENT_EXISTS":
                 event_item = ConcertronUpdatedItem(**main_data)
                 yield event_item
             elif event_status == "EVENT_UPDATE":
-                yield scrapy.Request(url=show_url, callback=self.parse_updated, meta={'main_data': main_data})
+                yield scrapy.Request(url=show_url, callback=self.parse_updated, errback=self.parse_unchanged, meta={'main_data': main_data, 'conditional': True})
         if len(response.css('li.agenda-list-item')) == 20 and 'page' not in response.url:
             yield scrapy.Request(url=str(self.start_urls[0] + '/page/2'), callback=self.parse)
         else:
@@ -181,6 +191,15 @@ class spiderEvents(scrapy.Spider):
         event_item = ConcertronUpdatedItem(**main_data)
         yield event_item
 
+    def parse_unchanged(self, failure): # Detail page is the same as last time, so only the agenda data and last_check are processed
+        if failure.check(NotModified):
+            main_data = failure.request.meta['main_data']
+            main_data['last_check'] = datetime.now()
+            event_item = ConcertronUpdatedItem(**main_data)
+            yield event_item
+        else:
+            self.logger.error(repr(failure))
+
 class spiderTags(scrapy.Spider):
     name = "nl_tivolivredenburg_tags"
     allowed_domains = ["www.tivolivredenburg.nl"]
@@ -1,6 +1,15 @@
 import pymongo
 from scrapy.utils.project import get_project_settings
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+from concertron.db import get_db
+from concertron.images import cache_paths
 from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from io import BytesIO
 import requests
@@ -11,20 +20,150 @@ settings = get_project_settings()
 mongo_uri=settings.get('MONGODB_URI')
 mongo_db=settings.get('MONGODB_DATABASE')
 collection_name=settings.get('MONGODB_COLLECTION')
-client = pymongo.MongoClient(mongo_uri)
-db = client[mongo_db]
+db = get_db(mongo_db, mongo_uri)
+mongo_pool = None
+
+def get_mongo_pool(): # Bounded thread pool for blocking pymongo calls, so they never run on the reactor thread
+    global mongo_pool
+    if mongo_pool is None:
+        from twisted.internet import reactor # Imported here so importing utils never installs a reactor
+        mongo_pool = ThreadPool(minthreads=1, maxthreads=settings.getint('MONGODB_THREADPOOL_SIZE', 4), name='mongodb')
+        mongo_pool.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', mongo_pool.stop)
+    return mongo_pool
+
+def defer_to_mongo(func, *args, **kwargs): # Runs func in the MongoDB thread pool and returns a Deferred with its result
+    from twisted.internet import reactor
+    return threads.deferToThreadPool(reactor, get_mongo_pool(), func, *args, **kwargs)
+
+image_pool = None
+
+def get_image_pool(): # Process pool for CPU-bound image work, shared by all crawlers in this process
+    global image_pool
+    if image_pool is None:
+        from twisted.internet import reactor
+        # Spawned rather than forked, forking a process with a running reactor and MongoDB threads is asking for trouble
+        image_pool = ProcessPoolExecutor(max_workers=settings.getint('IMAGES_PROCESS_WORKERS', 2), mp_context=multiprocessing.get_context('spawn'))
+        reactor.addSystemEventTrigger('before', 'shutdown', image_pool.shutdown)
+    return image_pool
+
+def defer_to_process(func, *args): # Runs func in the image process pool and returns a Deferred with its result
+    from twisted.internet import reactor
+    d = defer.Deferred()
+
+    def done(future):
+        if future.exception():
+            reactor.callFromThread(d.errback, future.exception())
+        else:
+            reactor.callFromThread(d.callback, future.result())
+
+    get_image_pool().submit(func, *args).add_done_callback(done)
+    return d
+
+relevant_fields = ['title', 'subtitle', 'support', 'date', 'location', 'tags', 'status'] # Fields compared in ConcertronPipeline.process_update
+
+class EventIndex: # Run-scoped copy of what the db knows about events, so spiders and pipelines in the same process don't keep asking MongoDB
+    def __init__(self):
+        self.projection = {field: 1 for field in ['last_check', 'agenda_digest'] + relevant_fields}
+        self.entries = {}
+        self.venues = set()
+
+    def load_venue(self, venue_id): # One projected scan per venue, called when a spider opens
+        if venue_id not in self.venues:
+            for entry in db[collection_name].find({'venue_id': venue_id}, self.projection):
+                self.entries[entry['_id']] = entry
+            self.venues.add(venue_id)
+
+    def is_loaded(self, _id): # Ids are formatted as {venue_id}-{internal_id}, so a miss for a loaded venue means the event is not in the db
+        # A lookup rather than going over self.venues, load_venue adds to it from the MongoDB thread pool while other spiders run
+        return _id.split('-', 1)[0] in self.venues
+
+    def get(self, _id):
+        entry = self.entries.get(_id)
+        if entry is None and not self.is_loaded(_id):
+            entry = db[collection_name].find_one({'_id': _id}, self.projection)
+            if entry:
+                self.entries[_id] = entry
+        return entry
+
+    def get_many(self, _ids):
+        found = {_id: self.entries[_id] for _id in _ids if _id in self.entries}
+        missing = [_id for _id in _ids if _id not in found and not self.is_loaded(_id)]
+        if missing:
+            for entry in db[collection_name].find({'_id': {'$in': missing}}, self.projection):
+                self.entries[entry['_id']] = entry
+                found[entry['_id']] = entry
+        return found
+
+    def update(self, _id, fields): # Call after every write to keep the index coherent with the db
+        entry = self.entries.setdefault(_id, {'_id': _id})
+        entry.update({field: value for field, value in fields.items() if field in self.projection})
+
+event_index = EventIndex()
+
+class ImageCache: # Maps image URLs to the content hash their files are stored under in IMAGES_CACHE_DIR, see concertron/images.py
+    def __init__(self):
+        self.collection = settings.get('IMAGES_CACHE_COLLECTION', 'images')
+        self.cache_dir = settings.get('IMAGES_CACHE_DIR', 'img/cache')
+        self.hashes = {} # url: hash
+        self.pending = {} # url: (hash, set of event ids), written on flush
+        self.loaded = False
+
+    def load(self): # Called when a spider opens, the first one loads it for the whole process
+        if not self.loaded:
+            for entry in db[self.collection].find({}, {'hash': 1}):
+                self.hashes[entry['_id']] = entry.get('hash')
+            self.loaded = True
+
+    def lookup(self, url): # Hash of the cached image for url, if its WEBP is still on disk
+        digest = self.hashes.get(url)
+        if digest and os.path.exists(cache_paths(self.cache_dir, digest)[1]):
+            return digest
+        return None
+
+    def add(self, url, digest, _id):
+        self.hashes[url] = digest
+        events = self.pending.setdefault(url, (digest, set()))[1]
+        events.add(_id)
+
+    def flush(self): # Blocking, run it with defer_to_mongo
+        pending, self.pending = self.pending, {}
+        if pending:
+            db[self.collection].bulk_write([
+                pymongo.UpdateOne({'_id': url}, {'$set': {'hash': digest}, '$addToSet': {'events': {'$each': sorted(events)}}}, upsert=True)
+                for url, (digest, events) in pending.items()
+                ], ordered=False)
+
+image_cache = ImageCache()
+
+def check_last_check(last_check): # Decides whether an existing event is due for a deep check
+    time_diff = datetime.now() - last_check
+    if time_diff > timedelta(days=3):
+        return "EVENT_UPDATE"
+    else:
+        return "EVENT_EXISTS"
 
 def does_event_exist(_id):
-    entry = db[collection_name].find_one({'_id': _id})
+    entry = event_index.get(_id)
     if entry:
-        time_diff = datetime.now() - entry.get('last_check')
-        if time_diff > timedelta(days=3):
-            return "EVENT_UPDATE"
-        else:
-            return "EVENT_EXISTS"
+        return check_last_check(entry.get('last_check'))
     else:
         return "EVENT_DOES_NOT_EXIST"
 
+def classify_events(_ids): # Bulk version of does_event_exist. Takes all ids from one agenda page and does at most one round trip instead of one per event
+    statuses = {_id: "EVENT_DOES_NOT_EXIST" for _id in _ids}
+    for _id, entry in event_index.get_many(list(statuses.keys())).items():
+        statuses[_id] = check_last_check(entry.get('last_check'))
+    return statuses
+
+def agenda_digest(main_data): # Stable fingerprint of the fields a spider takes from the agenda page
+    fields = {field: value for field, value in main_data.items() if field != 'agenda_digest'}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def agenda_unchanged(main_data): # True if the event's agenda row is the same as the one stored last run
+    entry = event_index.get(main_data.get('_id'))
+    return bool(entry) and entry.get('agenda_digest') == main_data.get('agenda_digest')
+
 def construct_datetime(lang, datefield, timefield=None): # This function exists for venues with no other date format than text like "Mo 01 jan 2024" and a separate time field.
     months = {
             'nl': {'jan': 1, 'feb': 2, 'mrt': 3, 'apr': 4, 'mei': 5, 'jun': 6, 'jul': 7, 'aug': 8, 'sep': 9, 'okt': 10, 'nov': 11, 'dec': 12},
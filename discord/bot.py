@@ -1,13 +1,21 @@
 import discord
-from discord.ext import tasks, commands
+from discord.ext import commands
 import logging
-from asyncio import sleep
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # For the shared concertron modules, before the local ones import them. Appended, so discord.py still wins over this folder
 
 # local modules
 import utils
 import keys
 import events
 import users
+import feed
+import notify
+import digest
+from executor import mongo
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -18,33 +26,76 @@ logger = logging.FileHandler(filename='./logs/discord.log', encoding='utf-8', mo
 emojis = ["🩷", "🧡", "💛", "💚", "💙", "🩵", "💜", "🤎", "🩶", "🤍", "💘", "💝", "💖", "💗", "💓", "💞", "💕", "💟"]
 
 client = discord.Client(intents=intents)
-agenda = events.find_events() # Only for '$next', remove soon (not a very useful feature, but good for debugging in current stage)
-
-@tasks.loop(minutes=5) # Fetch and process updates in db every 5 minutes
-async def send_updates():
-    for item in events.fetch_updates():
-        embed = utils.show_embed(item).get('embed') # Since the file needs to get loaded anyway for every send, dont take it.
-
-        if item['updates'] == 'new': # If event was newly added to the db
-            embed.set_author(name="New event")
-            for user in await users.create_sendlist(client, artists=item['lineup'], tags=item['tags']):
-                private = await user.send(file=discord.File(f"./img/{item['_id']}.webp", "image.webp"), embed=embed.copy())
-                await private.add_reaction("❤️") # Heart for event (and - for now - artist following
-
-        elif isinstance(item['updates'], list) and len(item['updates']) > 0: # If event has been updated, don't broadcast if there are no changes despite last_modified
-            head_text = "Update: " + ', '.join(item['updates'])
-            embed.set_author(name=head_text)
-
-            for user in await users.create_sendlist(client, artists=item['lineup'], events=[item['_id']]):
-                private = await user.send(file=discord.File(f"./img/{item['_id']}.webp", "image.webp"), embed=embed.copy())
-                await private.add_reaction("❤️")
-
-        message = await home_channel.send(file=discord.File(f"./img/{item['_id']}.webp", "image.webp"), embed=embed.copy())
-        await message.add_reaction("❤️")
-        # for i, artist in enumerate(item['lineup'], 0):
-            # await message.add_reaction(emojis[i])
-        await sleep(0.5)
-    events.write_success()
+feed_task = None
+agenda = iter([]) # Only for '$next', remove soon (not a very useful feature, but good for debugging in current stage)
+
+event_feed = feed.EventFeed(events.db, hold=digest.mode == 'digest') # In digest mode the digest saves the feed's progress
+
+dispatcher = notify.Dispatcher(make_file=discord.File)
+
+async def send_update(item): # Called by the feed for every new or updated event. Returns once the messages are sent, see notify.py
+    embed = utils.event_embed(item) # The image is read once below and shared by all sends instead
+
+    if item['updates'] == 'new': # If event was newly added to the db
+        embed.set_author(name="New event")
+
+    elif isinstance(item['updates'], list) and len(item['updates']) > 0: # If event has been updated, don't broadcast if there are no changes despite last_modified
+        head_text = "Update: " + ', '.join(item['updates'])
+        embed.set_author(name=head_text)
+
+    else:
+        return
+
+    recipients = (await users.resolve_sendlists(client, [item])).get(item['_id'], [])
+    image = await asyncio.to_thread(notify.load_attachment, f"./img/{item['_id']}.webp")
+    attachments = [(image, "image.webp")] if image else []
+    if not image: # Otherwise the embed points at an attachment that isn't there
+        embed.set_image(url=None)
+    sends = []
+    for user in recipients:
+        if user: # Not in the client's cache
+            sends.append(await dispatcher.submit(user, embed=embed, attachments=attachments, reaction="❤️")) # Heart for event (and - for now - artist following
+    home = await dispatcher.submit(home_channel, embed=embed, attachments=attachments, reaction="❤️")
+    # The feed saves its progress when this returns. Closed DMs are given up on, but if even the home channel post failed the
+    # event is tried again later
+    await notify.wait(sends, required=[home])
+    # for i, artist in enumerate(item['lineup'], 0):
+        # await message.add_reaction(emojis[i])
+
+event_digest = digest.Digest()
+
+async def send_digest(items): # Digest mode: all events of a cycle, grouped per recipient, see digest.py
+    sendlists = await users.resolve_sendlists(client, items)
+    items = [item for item in items if item['_id'] in sendlists] # Updates without changes have no send list
+    thumbs = {}
+    for item in items: # Once per event, not per recipient
+        thumbs[item['_id']] = await asyncio.to_thread(notify.load_attachment, digest.thumb_path(item['_id']))
+
+    recipients = {}
+    for item in items:
+        for user in sendlists[item['_id']]:
+            if user: # Not in the client's cache
+                recipients.setdefault(user, []).append(item)
+    recipients[home_channel] = items
+
+    sends, home = [], []
+    for destination, destination_items in recipients.items():
+        pages, left_out = event_digest.pages(destination_items)
+        for number, page in enumerate(pages, 1):
+            content = f"**{len(destination_items)} new and updated events** ({number}/{len(pages)})"
+            if number == len(pages) and left_out:
+                content += f"\n...and {left_out} more"
+            sent = await dispatcher.submit(destination, content=content,
+                    embeds=[digest.digest_embed(item) for item in page],
+                    attachments=[(thumbs[item['_id']], f"{item['_id']}.webp") for item in page if thumbs[item['_id']]])
+            (home if destination is home_channel else sends).append(sent)
+    await notify.wait(sends, required=home) # Like send_update, the digest only commits the feed's progress after this
+
+async def send_updates(): # Runs for as long as the bot does, see feed.py
+    if digest.mode == 'digest':
+        await asyncio.gather(event_feed.run(event_digest.add), event_digest.run(send_digest, event_feed))
+    else:
+        await event_feed.run(send_update)
 
 @client.event
 async def on_ready():
@@ -52,7 +103,9 @@ async def on_ready():
     home_channel = client.get_channel(keys.home)
     message = "Hello everyone! I'm here."
     await home_channel.send(message)
-    send_updates.start()
+    global feed_task
+    if feed_task is None or feed_task.done(): # on_ready also fires after reconnects
+        feed_task = asyncio.create_task(send_updates())
 
 @client.event
 async def on_reaction_add(reaction, user):
@@ -62,13 +115,13 @@ async def on_reaction_add(reaction, user):
     if reaction.message.author == client.user: # Check if message reacted to is from bot
         if str(reaction.emoji) == "❤️": # If :heart:/:red_heart:, add event, artists and tags to user profile
             event_url = reaction.message.embeds[0].url
-            event = events.find_events(filter_q={'url': event_url}).next()
+            event = await events.find_event(filter_q={'url': event_url})
             user_profile = await users.find_user(user.id)
 
             if user_profile: #If profile exists, add it
                 await users.update_user(user.id, event['_id'], event['lineup'], event['tags'])
             else: # If not, create profile and add information to it
-                await users.create_user(user.id, [event['_id']], event['lineup'], event['tags'])
+                await users.create_user(user.id, artists=event['lineup'], tags=event['tags'], events=[event['_id']])
 
             await user.send(f"{event['title']} has been added to your watchlist")
 
@@ -82,14 +135,29 @@ async def on_message(message):
         await message.channel.send(embed=discord.Embed(title="Hello", description="This is a test"))
 
     if message.content.startswith('$next'): # Leave for debugging
-        item = agenda.next()
-        await message.channel.send(**utils.show_embed(item))
+        global agenda
+        item = next(agenda, None)
+        if item is None: # Start over from the first upcoming event
+            agenda = iter(await events.find_events(limit=100))
+            item = next(agenda, None)
+        if item:
+            await message.channel.send(**utils.show_embed(item))
 
     if message.content.startswith('$artist'): # Search for artist in lineup fields in documents. TO-DO: no text appended should send a warning message. Rn it just sends ALL acts and needs to be killed inb4 rate limit
         await events.search_artist(message)
 
     if message.content.startswith('$update'): # Manually run the update cycle. TO-DO: Limit this to certain users/channels/roles
-        await send_updates()
+        if digest.mode == 'digest':
+            await event_feed.poll_once(event_digest.add, settle=0)
+            await event_digest.flush(send_digest, event_feed)
+        else:
+            await event_feed.poll_once(send_update, settle=0)
+
+    if message.content.startswith('$notifystats'): # Notification queue and throughput, see notify.py
+        await message.channel.send(f"```\n{dispatcher.report()}\n```")
+
+    if message.content.startswith('$dbstats'): # Database latency per operation, see executor.py
+        await message.channel.send(f"```\n{mongo.report()}\n```")
 
     if message.content.startswith('$watchlist'): # DM a user's profile to that user.
         user_profile = await users.find_user(message.author.id)
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import os
+from discord import Embed
+
+from concertron.db import get_setting
+
+# Digest mode (DISCORD_NOTIFY_MODE = 'digest'): instead of a message with a full size image per event per recipient, the
+# events of a cycle (DISCORD_DIGEST_WINDOW seconds) are collected and every recipient gets them in messages of up to
+# DISCORD_DIGEST_PER_MESSAGE compact embeds with thumbnails, at most DISCORD_DIGEST_PER_CYCLE events. The rest is only counted.
+
+log = logging.getLogger('discord.digest')
+
+mode = get_setting('DISCORD_NOTIFY_MODE', 'each') # each or digest
+
+class Digest:
+    def __init__(self):
+        self.window = get_setting('DISCORD_DIGEST_WINDOW', 300)
+        self.per_message = min(get_setting('DISCORD_DIGEST_PER_MESSAGE', 10), 10) # Discord takes at most 10 embeds per message
+        self.per_cycle = get_setting('DISCORD_DIGEST_PER_CYCLE', 50)
+        self.pending = {} # _id: event, a later version of the same event replaces the earlier one
+
+    async def add(self, item): # Handler for the feed
+        self.pending[item['_id']] = item
+
+    def take(self):
+        items, self.pending = list(self.pending.values()), {}
+        return sorted(items, key=lambda item: item['date'])
+
+    def pages(self, items): # Lists of at most per_message events, at most per_cycle events in total, and how many were left out
+        kept = items[:self.per_cycle]
+        return [kept[i:i + self.per_message] for i in range(0, len(kept), self.per_message)], len(items) - len(kept)
+
+    async def flush(self, send, feed): # Sends the collected events, then lets the feed (hold=True) save how far it got
+        items, held = self.take(), feed.take_held() # Together, so nothing can come in between
+        try:
+            if items:
+                await send(items)
+        except Exception:
+            for item in items: # Back for the next cycle, a newer version that came in since wins
+                self.pending.setdefault(item['_id'], item)
+            feed.restore(held)
+            raise
+        await feed.commit(held)
+
+    async def run(self, send, feed): # Every window
+        while True:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush(send, feed)
+            except Exception as e:
+                log.error(f"Sending the digest failed, trying again next cycle: {e!r}")
+
+def digest_embed(item): # Smaller than utils.show_embed: no image, a thumbnail (see thumb_attachment) and no support acts
+    if item.get('updates') == 'new':
+        author = "New event"
+    else:
+        author = "Update: " + ', '.join(item.get('updates') or [])
+    embed = Embed(
+            title = item['title'],
+            description = f"{item.get('location')} · {' '.join(item['status'].split('_')).capitalize()}",
+            url = item['url'],
+            timestamp = item['date']
+            )
+    embed.set_author(name=author)
+    embed.set_thumbnail(url=f"attachment://{item['_id']}.webp")
+    return embed
+
+def thumb_path(_id): # The thumb derivative when there is one (see IMAGES_SIZES), the full image otherwise
+    path = f"./img/sizes/thumb/{_id}.webp"
+    return path if os.path.exists(path) else f"./img/{_id}.webp"
@@ -1,15 +1,18 @@
-import pymongo
 from datetime import datetime
 import utils
+from executor import mongo
 
-client = pymongo.MongoClient('mongodb://concertron-mongodb:27017')
-db = client['concertron']
+from concertron.db import get_db, ensure_indexes
+from concertron import search
+
+db = get_db()
 
 def db_init(): # Makes sure a last_check field is set upon starting up to prevent a clean setup blasting all events everywhere (that would be a lot)
+    ensure_indexes(db)
     if not db.system.find_one({'_id': 'discord'}):
         db.system.insert_one({'_id': 'discord', 'last_check': datetime.now()})
 
-def find_events(filter_q=None, sort_q=None): # Queries a default plus whatever the code calling it needs
+def events_query(filter_q=None, sort_q=None): # Queries a default plus whatever the code calling it needs
     # Query defaults
     filter = {
             '$or': [
@@ -26,20 +29,22 @@ def find_events(filter_q=None, sort_q=None): # Queries a default plus whatever t
     if sort_q:
         sort.update(sort_q)
 
-    return db.events.find(filter=filter, sort=sort)
+    return filter, sort
 
-def fetch_updates():
-    filter = {'last_modified': {'$gt': db.system.find_one({'_id': 'discord'}).get('last_check')}} # Only get documents updated after the last check
-    return find_events(filter_q=filter)
+async def find_events(filter_q=None, sort_q=None, limit=0): # List, the cursor is read in the executor (see executor.py)
+    filter, sort = events_query(filter_q, sort_q)
+    return await mongo.run('events.find_events', lambda: list(db.events.find(filter=filter, sort=sort, limit=limit)))
 
-def write_success():
-    db.system.update_one({'_id': 'discord'}, {'$set': {'last_check': datetime.now()}}) # Just as a flag
+async def find_event(filter_q): # First match or None
+    events = await find_events(filter_q, limit=1)
+    return events[0] if events else None
 
 async def search_artist(message): # Search for artist in lineup fields in documents. TO-DO: no text appended should send a warning message. Rn it just sends ALL acts and needs to be killed inb4 rate limit
     content = message.content.split('$artist')[1].strip()
     if content:
-        results = find_events({'lineup': {'$regex': content, '$options': 'i'}})
-        if len(list(results.clone())) > 0:
+        event_ids = await mongo.run('search.find_event_ids', search.find_event_ids, db, content)
+        results = await find_events({'_id': {'$in': event_ids}})
+        if len(results) > 0:
             for match in results:
                 sent = await message.channel.send(**utils.show_embed(match))
                 await sent.add_reaction("❤️")
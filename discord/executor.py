@@ -0,0 +1,53 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import time
+
+from concertron.db import get_setting
+
+# pymongo blocks, and anything blocking in a coroutine freezes discord.py's event loop (heartbeats, reactions, commands).
+# Every database call of the bot goes through mongo.run(), which runs it on a small thread pool. Cursors have to be turned
+# into lists inside the function that is run, iterating them in a coroutine would do the network round trips on the loop again.
+# Latency (queue wait included) is kept per operation in a histogram, $dbstats shows it.
+
+buckets = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf')] # Upper bounds in ms
+
+class MongoExecutor:
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mongodb')
+        self.lock = threading.Lock()
+        self.histograms = {} # operation: {'counts': [per bucket], 'total': ms, 'max': ms}
+
+    async def run(self, operation, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, functools.partial(func, *args, **kwargs))
+        finally:
+            self.record(operation, (time.monotonic() - start) * 1000)
+
+    def record(self, operation, ms):
+        with self.lock:
+            histogram = self.histograms.setdefault(operation, {'counts': [0] * len(buckets), 'total': 0.0, 'max': 0.0})
+            histogram['counts'][next(i for i, bound in enumerate(buckets) if ms <= bound)] += 1
+            histogram['total'] += ms
+            histogram['max'] = max(histogram['max'], ms)
+
+    def percentile(self, histogram, fraction): # Upper bound of the bucket the percentile falls in
+        target = sum(histogram['counts']) * fraction
+        seen = 0
+        for bound, count in zip(buckets, histogram['counts']):
+            seen += count
+            if seen >= target:
+                return bound
+        return buckets[-1]
+
+    def report(self):
+        with self.lock:
+            lines = []
+            for operation, histogram in sorted(self.histograms.items()):
+                count = sum(histogram['counts'])
+                lines.append(f"{operation:<28}{count:>7} calls  avg {histogram['total'] / count:7.1f} ms  p50 <={self.percentile(histogram, 0.5):g} ms  p95 <={self.percentile(histogram, 0.95):g} ms  max {histogram['max']:7.1f} ms")
+            return '\n'.join(lines) or "No database calls yet"
+
+mongo = MongoExecutor(get_setting('DISCORD_MONGODB_WORKERS', 4))
@@ -0,0 +1,195 @@
+import asyncio
+from datetime import datetime, timedelta
+import logging
+import pymongo
+from pymongo.errors import OperationFailure
+
+from concertron.db import get_setting
+from executor import mongo
+
+# Feed of new and updated events for send_updates. Two ways of getting them:
+# - A change stream on events (needs MongoDB running as a replica set). Events come in as they are written, and the resume
+#   token is saved after each one is handled, so a restart picks up where it left off.
+# - Polling, when change streams are not available. Goes by a watermark (last_modified and _id of the last event handled),
+#   which only moves past events that were actually handled. Events younger than DISCORD_FEED_SETTLE seconds are left for the
+#   next poll, as the crawler writes them in batches and one with an older last_modified can still come in.
+# Either way only events with a new last_modified are passed on, updates that only touch last_check are ignored.
+# State lives in db.system {'_id': 'discord'}: 'resume_token', and 'last_check' + 'last_id' as the watermark.
+# A handler that fails stops the cycle, the event is tried again on the next one (poll, or the reopened stream). After
+# DISCORD_FEED_MAX_ATTEMPTS failures in a row it is logged and skipped, so one broken event can't hold up the feed for good.
+# With hold=True (digest mode) handling an event only means it was buffered, so nothing is saved then: the token and the
+# furthest event are held until take_held() + commit(), which the digest calls once the messages are sent.
+
+log = logging.getLogger('discord.feed')
+
+event_types = ['Concert', 'Festival', 'Club'] # Same as events.find_events
+
+class EventFeed:
+    def __init__(self, db, collection='events', hold=False):
+        self.db = db
+        self.collection = db[collection]
+        self.mode = get_setting('DISCORD_FEED_MODE', 'auto') # auto, stream or poll
+        self.poll_interval = get_setting('DISCORD_POLL_INTERVAL', 300)
+        self.settle = get_setting('DISCORD_FEED_SETTLE', 60)
+        self.max_attempts = get_setting('DISCORD_FEED_MAX_ATTEMPTS', 3)
+        self.failures = {} # _id: failed attempts so far
+        self.hold = hold
+        self.held = {} # 'token' and 'item' (the furthest event) handled but not committed yet
+        self.position = None # (last_modified, _id) of the furthest event handled while holding, so polls don't fetch it again
+
+    def state(self):
+        return self.db.system.find_one({'_id': 'discord'}) or {}
+
+    def relevant(self, item): # What find_events would have returned
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return item.get('event_type') in event_types and item.get('date') and item['date'] > today
+
+    # Change stream
+
+    def stream_available(self):
+        if self.mode == 'poll':
+            return False
+        try:
+            with self.collection.watch(max_await_time_ms=1):
+                return True
+        except OperationFailure: # Not a replica set
+            if self.mode == 'stream':
+                raise
+            return False
+
+    def open_stream(self): # Returns the stream and whether it resumed from a saved token
+        pipeline = [{'$match': {'$or': [
+            {'operationType': {'$in': ['insert', 'replace']}},
+            {'operationType': 'update', 'updateDescription.updatedFields.last_modified': {'$exists': True}},
+            ]}}]
+        token = self.state().get('resume_token')
+        if token:
+            try:
+                return self.collection.watch(pipeline, full_document='updateLookup', resume_after=token, max_await_time_ms=1000), True
+            except OperationFailure: # Token too old for the oplog
+                log.warning("Resume token no longer valid, starting a new change stream")
+        return self.collection.watch(pipeline, full_document='updateLookup', max_await_time_ms=1000), False
+
+    def save_token(self, token):
+        self.db.system.update_one({'_id': 'discord'}, {'$set': {'resume_token': token}}, upsert=True)
+
+    async def run_stream(self, handle):
+        stream, resumed = await mongo.run('feed.open_stream', self.open_stream)
+        with stream:
+            if not resumed: # Catch up on what came in while there was no stream. Opened first, so nothing falls in between
+                await self.poll_once(handle, settle=0)
+            while stream.alive:
+                change = await mongo.run('feed.try_next', stream.try_next) # Blocks for at most max_await_time_ms
+                if change is None:
+                    continue
+                item = change.get('fullDocument')
+                if item and self.relevant(item):
+                    await self.deliver(handle, item)
+                await self.checkpoint(item, change['_id']) # The watermark too, for when the bot has to fall back to polling
+
+    # Polling
+
+    def watermark(self):
+        state = self.state()
+        watermark = (state.get('last_check') or datetime.now(), state.get('last_id') or '')
+        if self.position and self.position > watermark: # Held, not committed yet
+            return self.position
+        return watermark
+
+    def poll(self, limit=500, settle=None): # Events modified after the watermark, oldest first
+        last_modified, last_id = self.watermark()
+        settle = self.settle if settle is None else settle
+        filter = {
+                '$and': [
+                    {'$or': [{'last_modified': {'$gt': last_modified}}, {'last_modified': last_modified, '_id': {'$gt': last_id}}]},
+                    {'last_modified': {'$lte': datetime.now() - timedelta(seconds=settle)}},
+                    ],
+                }
+        return list(self.collection.find(filter, sort=[('last_modified', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], limit=limit))
+
+    def advance(self, item): # Only ever to an event that was handled, and only forward (stream events can come in out of order)
+        last_modified = item['last_modified']
+        self.db.system.update_one(
+                {'_id': 'discord', '$or': [
+                    {'last_check': None},
+                    {'last_check': {'$lt': last_modified}},
+                    {'last_check': last_modified, 'last_id': {'$lt': item['_id']}},
+                    ]},
+                {'$set': {'last_check': last_modified, 'last_id': item['_id']}},
+                )
+
+    async def deliver(self, handle, item): # Raises on failure, unless the event has failed max_attempts times: then it is skipped
+        try:
+            await handle(item)
+        except Exception as e:
+            attempts = self.failures.get(item['_id'], 0) + 1
+            if attempts < self.max_attempts:
+                self.failures[item['_id']] = attempts
+                raise
+            self.failures.pop(item['_id'], None)
+            log.error(f"Skipping event {item['_id']} after {attempts} failed attempts: {e!r}")
+        else:
+            self.failures.pop(item['_id'], None)
+
+    # Saving progress
+
+    async def checkpoint(self, item=None, token=None): # After an event was handled (or skipped)
+        if self.hold:
+            if token is not None:
+                self.held['token'] = token
+            if item and item.get('last_modified'):
+                position = (item['last_modified'], item['_id'])
+                if not self.position or position > self.position:
+                    self.position = position
+                    self.held['item'] = item
+            return
+        if token is not None:
+            await mongo.run('feed.save_token', self.save_token, token)
+        if item and item.get('last_modified'):
+            await mongo.run('feed.advance', self.advance, item)
+
+    def take_held(self): # Call together with taking the buffered events, without an await in between
+        held, self.held = self.held, {}
+        return held
+
+    async def commit(self, held): # Once the events buffered with it are sent
+        if held.get('token') is not None:
+            await mongo.run('feed.save_token', self.save_token, held['token'])
+        if held.get('item'):
+            await mongo.run('feed.advance', self.advance, held['item'])
+
+    def restore(self, held): # Sending failed, hold on to it again. Whatever was held since is further along
+        for key, value in held.items():
+            self.held.setdefault(key, value)
+
+    async def poll_once(self, handle, settle=None, limit=500):
+        handled = 0
+        while True:
+            items = await mongo.run('feed.poll', self.poll, limit, settle)
+            for item in items:
+                if self.relevant(item):
+                    await self.deliver(handle, item)
+                await self.checkpoint(item)
+            handled += len(items)
+            if len(items) < limit:
+                return handled
+
+    async def run_polling(self, handle):
+        while True:
+            try:
+                await self.poll_once(handle)
+            except Exception as e: # Not only MongoDB: a failing handler must not end the feed either
+                log.error(f"Polling for updates failed: {e!r}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def run(self, handle): # handle is a coroutine function taking an event document
+        if await mongo.run('feed.stream_available', self.stream_available):
+            while True:
+                try:
+                    await self.run_stream(handle)
+                except Exception as e: # Reopened from the saved token, so a failed event comes in again
+                    log.error(f"Change stream failed, reopening: {e!r}")
+                    await asyncio.sleep(5)
+        else:
+            log.info("Change streams not available, polling for updates")
+            await self.run_polling(handle)
@@ -0,0 +1,151 @@
+import asyncio
+from io import BytesIO
+import logging
+import time
+
+from concertron.db import get_setting
+
+# Sends the bot's notifications from a queue with a fixed number of workers, instead of one await after the other.
+# - Rate limits are kept per route (a DM channel or a text channel) and globally with token buckets, so a big fan-out does
+#   not run into 429s. discord.py still handles the ones that slip through.
+# - Attachments are passed as bytes, read once per event. Every send gets its own file object around them.
+# - Failed sends are retried with exponential backoff, except for ones that will never work (DMs closed: 403, 404).
+#   Reactions are not: a message whose reaction failed is still sent, and is never sent again for it.
+# Destinations only need an async send(content=, file(s)=, embed(s)=) returning something with an async add_reaction(), so it works
+# with a fake client as well as with discord.py.
+
+log = logging.getLogger('discord.notify')
+
+class DeliveryError(Exception): # A message that had to be delivered could not be, see wait()
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = rate
+        self.per = per
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.per)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.capacity)
+
+class Dispatcher:
+    def __init__(self, make_file=None, concurrency=None, route_rate=None, route_per=None, global_rate=None, retries=None, backoff=None, queue_size=None):
+        self.make_file = make_file # (fp, filename) -> file object, discord.File in the bot
+        self.concurrency = concurrency or get_setting('DISCORD_NOTIFY_CONCURRENCY', 8)
+        self.route_rate = route_rate or get_setting('DISCORD_ROUTE_RATE', 5) # Discord allows about 5 messages per 5 seconds per channel
+        self.route_per = route_per or get_setting('DISCORD_ROUTE_PER', 5)
+        self.retries = retries if retries is not None else get_setting('DISCORD_NOTIFY_RETRIES', 3)
+        self.backoff = backoff if backoff is not None else get_setting('DISCORD_NOTIFY_BACKOFF', 1)
+        self.global_bucket = TokenBucket(global_rate or get_setting('DISCORD_GLOBAL_RATE', 40), 1)
+        self.buckets = {} # route: TokenBucket
+        self.queue = asyncio.Queue(maxsize=queue_size or get_setting('DISCORD_NOTIFY_QUEUE_SIZE', 1000)) # Full queue makes submit wait
+        self.workers = []
+        self.stats = {'submitted': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0, 'reaction_failed': 0, 'max_queue_depth': 0, 'send_time_total': 0.0}
+        self.started = None
+
+    def start(self):
+        if not self.workers:
+            self.started = time.monotonic()
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    async def submit(self, destination, embed=None, embeds=None, attachments=None, reaction=None, content=None):
+        # attachments is a list of (bytes, filename). Returns a future with the sent message, or None if it failed for good
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((destination, embed, embeds, attachments or [], reaction, content, future))
+        self.stats['submitted'] += 1
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.queue.qsize())
+        return future
+
+    def route(self, destination):
+        return (type(destination).__name__, getattr(destination, 'id', id(destination)))
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                message = await self.send(*job[:6])
+                if not job[6].done():
+                    job[6].set_result(message)
+            except Exception as e: # Never let one notification take a worker down
+                log.error(f"Notification failed: {e!r}")
+                if not job[6].done():
+                    job[6].set_result(None)
+            finally:
+                self.queue.task_done()
+
+    async def send(self, destination, embed, embeds, attachments, reaction, content=None):
+        bucket = self.buckets.setdefault(self.route(destination), TokenBucket(self.route_rate, self.route_per))
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            kwargs = {'content': content} if content else {}
+            if embeds:
+                kwargs['embeds'] = [e.copy() for e in embeds]
+            elif embed:
+                kwargs['embed'] = embed.copy()
+            files = [self.make_file(BytesIO(data), filename) for data, filename in attachments] # A file object can only be sent once
+            if len(files) == 1:
+                kwargs['file'] = files[0]
+            elif files:
+                kwargs['files'] = files
+            start = time.monotonic()
+            try:
+                message = await destination.send(**kwargs)
+            except Exception as e:
+                status = getattr(e, 'status', None)
+                if status in (403, 404) or attempt == self.retries: # Closed DMs and the like, or out of retries
+                    self.stats['failed'] += 1
+                    log.warning(f"Could not send to {self.route(destination)}: {e!r}")
+                    return None
+                self.stats['retried'] += 1
+                delay = self.backoff * 2 ** attempt
+                if status == 429:
+                    self.stats['rate_limited'] += 1
+                    delay = max(delay, getattr(e, 'retry_after', 0) or 0)
+                await asyncio.sleep(delay)
+            else:
+                self.stats['sent'] += 1
+                self.stats['send_time_total'] += time.monotonic() - start
+                if reaction: # The message is out, a failed reaction must not send it again
+                    try:
+                        await message.add_reaction(reaction)
+                    except Exception as e:
+                        self.stats['reaction_failed'] += 1
+                        log.warning(f"Could not react to a message to {self.route(destination)}: {e!r}")
+                return message
+
+    def report(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        stats = dict(self.stats)
+        stats['queue_depth'] = self.queue.qsize()
+        stats['per_second'] = round(stats['sent'] / elapsed, 2) if elapsed else 0.0
+        stats['send_avg_ms'] = round(stats.pop('send_time_total') / stats['sent'] * 1000, 1) if stats['sent'] else 0.0
+        return stats
+
+async def wait(futures, required=()): # Until the submitted messages are sent (or given up on). Raises if one in required failed
+    await asyncio.gather(*futures, *required)
+    failed = sum(1 for future in required if future.result() is None)
+    if failed:
+        raise DeliveryError(f"{failed} of {len(required)} required messages could not be sent")
+
+def load_attachment(path): # Read once per event, the bytes go to every recipient
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from concertron.db import get_setting
+from executor import mongo
+
+# Who follows what, the other way around: artist/tag/event -> ids of the users following it. Built from discord_users in one
+# read, kept up to date by users.create_user/update_user and rebuilt every ttl seconds in case profiles were changed elsewhere.
+# Finding the recipients of an event is then a few dict lookups instead of a query over all profiles.
+
+fields = ('artists', 'tags', 'events')
+
+class SubscriptionIndex:
+    def __init__(self, db, ttl=None):
+        self.db = db
+        self.ttl = ttl or get_setting('DISCORD_SUBSCRIPTIONS_TTL', 600)
+        self.index = {field: {} for field in fields}
+        self.built = None
+        self.lock = asyncio.Lock() # One rebuild at a time
+        self.pending = None # Adds made while a rebuild runs, replayed onto the new index
+
+    def build(self): # Blocking, run it in the executor
+        index = {field: {} for field in fields}
+        for user in self.db.discord_users.find({}, {field: 1 for field in fields}):
+            for field in fields:
+                for value in user.get(field) or []:
+                    index[field].setdefault(value, set()).add(user['_id'])
+        return index
+
+    async def ensure(self):
+        async with self.lock:
+            if self.built is None or time.monotonic() - self.built > self.ttl:
+                self.pending = []
+                try:
+                    index = await mongo.run('subscriptions.build', self.build)
+                finally:
+                    pending, self.pending = self.pending, None
+                self.index = index
+                for add in pending: # The build may have read discord_users before these were written
+                    self.add(*add)
+                self.built = time.monotonic()
+
+    def add(self, user_id, artists=(), tags=(), events=()): # Call after writing the same to discord_users
+        if self.pending is not None:
+            self.pending.append((user_id, artists, tags, events))
+        for field, values in (('artists', artists), ('tags', tags), ('events', events)):
+            for value in values or []:
+                self.index[field].setdefault(value, set()).add(user_id)
+
+    def invalidate(self):
+        self.built = None
+
+    def lookup(self, artists=None, tags=None, events=None): # Same matches as an $or of $in's on discord_users
+        user_ids = set()
+        for field, values in (('artists', artists), ('tags', tags), ('events', events)):
+            for value in values or []:
+                user_ids.update(self.index[field].get(value, ()))
+        return user_ids
+
+    async def resolve(self, queries): # {key: {'artists': [...], 'tags': [...], 'events': [...]}} -> {key: set of user ids}
+        await self.ensure()
+        return {key: self.lookup(**query) for key, query in queries.items()}
+
+def sendlist_query(item): # What the followers of an event are matched on, None if the event should not be sent at all
+    if item.get('updates') == 'new':
+        return {'artists': item.get('lineup'), 'tags': item.get('tags')}
+    elif isinstance(item.get('updates'), list) and len(item['updates']) > 0:
+        return {'artists': item.get('lineup'), 'events': [item['_id']]}
+    return None
@@ -1,12 +1,15 @@
-import pymongo
 from datetime import datetime
 import utils
+from executor import mongo
+from subscriptions import SubscriptionIndex, sendlist_query
 
-client = pymongo.MongoClient('mongodb://concertron-mongodb:27017')
-db = client['concertron']
+from concertron.db import get_db
+
+db = get_db()
+subscriptions = SubscriptionIndex(db)
 
 async def create_user(_id, artists=[], tags=[], events=[], notify_all=False):
-    db.discord_users.insert_one({
+    await mongo.run('users.create_user', db.discord_users.insert_one, {
         "_id": _id,
         "created": datetime.now(),
         "artists": utils.str_to_list(artists), # Str to list only used as failsafe for mistakes made in later development
@@ -14,17 +17,24 @@ async def create_user(_id, artists=[], tags=[], events=[], notify_all=False):
         "events": utils.str_to_list(events),
         "notify_all": notify_all
         })
+    subscriptions.add(_id, utils.str_to_list(artists), utils.str_to_list(tags), utils.str_to_list(events))
 
 async def find_user(_id):
-    return db.discord_users.find_one({'_id': _id})
+    return await mongo.run('users.find_user', db.discord_users.find_one, {'_id': _id})
 
 async def update_user(_id, events=[], artists=[], tags=[]):
-    db.discord_users.update_one(
+    events = utils.str_to_list(events) # A single event id or a list of them
+    await mongo.run('users.update_user', db.discord_users.update_one,
             {"_id": _id},
-            {"$addToSet": {"events": events, "artists": {"$each": artists}, "tags": {"$each": tags}}}
+            {"$addToSet": {"events": {"$each": events}, "artists": {"$each": artists}, "tags": {"$each": tags}}}
             )
+    subscriptions.add(_id, artists, tags, events)
 
 async def create_sendlist(discord, artists=None, tags=None, events=None): # Generates a list of discord user objects for a message to be sent to
-    variables = {'artists': artists, 'tags': tags, 'events': events}
-    matches = db.discord_users.find({'$or': [{var: {'$in': val}} for var, val in variables.items() if val and isinstance(val, list)]})
-    return [discord.get_user(_id) for _id in matches.distinct('_id')]
+    await subscriptions.ensure()
+    return [discord.get_user(_id) for _id in subscriptions.lookup(artists, tags, events)]
+
+async def resolve_sendlists(discord, items): # create_sendlist for a whole batch of events at once: {event _id: [users]}
+    queries = {item['_id']: sendlist_query(item) for item in items}
+    queries = {_id: query for _id, query in queries.items() if query}
+    return {_id: [discord.get_user(user_id) for user_id in user_ids] for _id, user_ids in (await subscriptions.resolve(queries)).items()}
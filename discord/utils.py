@@ -9,7 +9,10 @@ def str_to_list(string):
         raise Exception("Type is neither str nor list!")
 
 def show_embed(item): # Generate an embed for a show. Item is a MongoDB document/dict
-    file = File(f"./img/{item['_id']}.webp", "image.webp") # Made for convenience's sake, but not required. Use utils.show_embed(item)['embed'] and add discord.File separately
+    file = File(f"./img/{item['_id']}.webp", "image.webp") # Made for convenience's sake, but not required. Use utils.event_embed(item) and add discord.File separately
+    return {'file': file, 'embed': event_embed(item)}
+
+def event_embed(item): # Just the embed, expecting the image as an attachment named image.webp. Opens no files
     embed = Embed(
             title = item['title'],
             description = item['subtitle'],
@@ -21,4 +24,4 @@ def show_embed(item): # Generate an embed for a show. Item is a MongoDB document
         embed.add_field(name='Support', value='\n'.join(item['support']))
     embed.add_field(name='Status', value=' '.join(item['status'].split('_')).capitalize())
     embed.set_image(url="attachment://image.webp")
-    return {'file': file, 'embed': embed}
+    return embed
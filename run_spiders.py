@@ -1,50 +1,209 @@
-import scrapy
-from twisted.internet import reactor, defer
-# from twisted.internet import defer
-from scrapy.crawler import CrawlerRunner
-from scrapy.utils.log import configure_logging
-from scrapy.utils.project import get_project_settings
 # from scrapy.utils.reactor import install_reactor
-import importlib
-import pkgutil
-import pymongo
+from concertron.db import get_db, close_clients, ensure_indexes, collscan_report
+from concertron.images import evict, remove_files, size_path
+from concertron import search
 from datetime import datetime, timedelta
+import argparse
+import multiprocessing
 import os
+from queue import Empty
 import shutil
+import sys
+import time
 
-settings = get_project_settings()
-configure_logging(settings)
-runner = CrawlerRunner(settings)
+# Spawned processes (the image pool and the shards) import this script again, so nothing Scrapy or Twisted happens at import
+# time: settings, logging and the runner are set up by setup(), the rest is imported where it is used.
+settings = None
+runner = None
 
-client = pymongo.MongoClient(settings['MONGODB_URI'])
-db = client[settings['MONGODB_DATABASE']]
+def setup():
+    global settings, runner
+    from scrapy.crawler import CrawlerRunner
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.project import get_project_settings
+    settings = get_project_settings()
+    configure_logging(settings)
+    runner = CrawlerRunner(settings)
 
-@defer.inlineCallbacks
-def crawl():
-    spiders_package = importlib.import_module("concertron.spiders")
-    for importer, modname, ispkg in pkgutil.iter_modules(spiders_package.__path__):
-        module = importlib.import_module(f"concertron.spiders.{modname}")
-        for name in dir(module):
-            obj = getattr(module, name)
-            if isinstance(obj, type) and issubclass(obj, scrapy.Spider) and obj != scrapy.Spider:
-                yield runner.crawl(obj)
+def get_system_db(): # Not at import time, the registry and runner should not have to wait for MongoDB
+    return get_db(settings['MONGODB_DATABASE'], settings['MONGODB_URI'])
 
-    reactor.stop()
-    db.system.update_one({'_id': 'scraper'}, {'$set': {'last_run': datetime.now()}}, upsert=True)
+def group_by_venue(spiders): # Each venue gets its own queue, with the _events spider before the _tags spider as tags need the events in the db
+    venues = {}
+    for spider in spiders:
+        venues.setdefault(spider['venue_id'], []).append(spider)
+    for queue in venues.values():
+        queue.sort(key=lambda spider: spider['kind'] == 'tags')
+    return venues
+
+def crawl_venue(queue, results): # Run with inlineCallbacks. Spiders of one venue run one after the other, so a venue's domains never see more than one crawler at a time
+    for spider in queue:
+        start = time.monotonic()
+        crawler = None
+        try:
+            crawler = runner.create_crawler(spider['name']) # Only now is the spider's module imported, which can fail too
+            yield runner.crawl(crawler)
+            results.append((spider['name'], time.monotonic() - start, 'ok', crawler.stats.get_stats()))
+        except Exception as e:
+            results.append((spider['name'], time.monotonic() - start, f'failed: {e!r}', crawler.stats.get_stats() if crawler else {}))
+
+def print_timings(results, total):
+    print(f"{'Spider':<32}{'Time (s)':>10}  Result")
+    for name, duration, result, stats in sorted(results, key=lambda result: -result[1]):
+        print(f"{name:<32}{duration:>10.1f}  {result}")
+    print(f"{'Total wall-clock':<32}{total:>10.1f}")
+
+def print_stats(results): # Totals of the numeric crawl stats over all spiders
+    totals = {}
+    for name, duration, result, stats in results:
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0) + value
+    for key in sorted(totals):
+        print(f"{key:<64}{totals[key]:>16}")
+
+def crawl(max_parallel=1, venue_ids=None, kinds=None):
+    from twisted.internet import defer
+    from concertron import registry
+    results = []
+    semaphore = defer.DeferredSemaphore(max_parallel) # Max number of venues (so spiders) crawling at the same time
+    venues = group_by_venue(registry.find(venue_ids, kinds))
+    d = defer.DeferredList([semaphore.run(defer.inlineCallbacks(crawl_venue), queue, results) for queue in venues.values()], consumeErrors=True)
+
+    def collect(outcomes): # Anything crawl_venue did not catch still counts as a failure of that venue
+        for venue_id, (success, result) in zip(venues, outcomes):
+            if not success:
+                results.append((venue_id, 0.0, f'failed: {result.getErrorMessage()}', {}))
+        return results
+
+    return d.addCallback(collect)
+
+def run(max_parallel=1, venue_ids=None, kinds=None): # Runs the crawl in this process' reactor and returns the results once it is done
+    from twisted.internet import reactor
+    results = []
+
+    def start(): # Once the reactor runs: a crawl that is over right away (no spiders, all failing to import) can't stop it before that
+        d = crawl(max_parallel, venue_ids, kinds)
+        d.addCallback(results.extend)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+    return results
+
+def run_shard(venue_ids, kinds, max_parallel, per_domain, output): # Entry point of a worker process, which has its own reactor and settings
+    setup()
+    if per_domain:
+        runner.settings.set('CONCURRENT_REQUESTS_PER_DOMAIN', per_domain, priority='cmdline')
+    results = run(max_parallel, venue_ids, kinds)
+    output.put(results)
+    sys.exit(0 if results and all(result[2] == 'ok' for result in results) else 1)
+
+def run_sharded(processes, max_parallel, per_domain, venue_ids=None, kinds=None): # Spreads the venues over worker processes so parsing and image work use more than one core
+    from concertron import registry
+    venues = group_by_venue(registry.find(venue_ids, kinds))
+    shards = [[] for _ in range(processes)]
+    for i, venue_id in enumerate(sorted(venues, key=lambda venue_id: -len(venues[venue_id]))):
+        shards[i % processes].append(venue_id)
+
+    context = multiprocessing.get_context('spawn') # A fresh interpreter per worker, as a reactor can't be shared with a fork
+    output = context.Queue()
+    workers = [context.Process(target=run_shard, args=(shard, kinds, max_parallel, per_domain, output), name=f"shard-{i}") for i, shard in enumerate(shards) if shard]
+    for worker in workers:
+        worker.start()
+
+    results = []
+    received = 0
+    deadline = time.monotonic() + settings.getint('CRAWL_SHARD_TIMEOUT', 3 * 3600)
+    while received < len(workers): # Read before joining, a worker can't exit while its results are stuck in the queue
+        try:
+            results.extend(output.get(timeout=5))
+            received += 1
+        except Empty:
+            if not any(worker.is_alive() for worker in workers): # Crashed before reporting back
+                break
+            if time.monotonic() > deadline:
+                print("Timed out waiting for shards, terminating them")
+                for worker in workers:
+                    worker.terminate()
+                break
+    for worker in workers:
+        worker.join()
+
+    succeeded = all(worker.exitcode == 0 for worker in workers)
+    for worker in workers:
+        if worker.exitcode != 0:
+            print(f"{worker.name} exited with code {worker.exitcode}")
+    return results, succeeded
 
 def clean_up():
+    db = get_system_db()
     query = {'date': {'$lt': datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)-timedelta(days=1)}}
 
     if os.path.exists("./img/dl/full"):
         shutil.rmtree("./img/dl/full")
 
-    for _id in db.events.find(query).distinct('_id'):
+    sizes = settings.getdict('IMAGES_SIZES')
+    past_ids = db.events.find(query).distinct('_id')
+    for _id in past_ids:
         if os.path.exists(f"./img/{_id}.webp"):
             os.remove(f"./img/{_id}.webp")
+        remove_files([size_path('./img', _id, size) for size in sizes])
+    if past_ids:
+        evict(db, settings.get('IMAGES_CACHE_COLLECTION', 'images'), settings.get('IMAGES_CACHE_DIR', 'img/cache'), past_ids, sizes)
+        search.remove_events(db, past_ids)
     
     db.events.delete_many(query)
+    db[settings.get('CONDITIONAL_COLLECTION', 'http_cache')].delete_many({'checked': {'$lt': datetime.now() - timedelta(days=90)}}) # Validators of pages not seen in a long time
+
+def write_last_run():
+    get_system_db().system.update_one({'_id': 'scraper'}, {'$set': {'last_run': datetime.now()}}, upsert=True)
+
+def bump_data_version(): # After every run, partial and failed ones included: they still wrote events. Same stamp as FacetCache.bump('events')
+    get_system_db().system.update_one({'_id': 'events'}, {'$inc': {'version': 1}}, upsert=True)
 
 if __name__ == '__main__':
-    crawl()
-    reactor.run()
+    setup()
+    from concertron import registry
+    parser = argparse.ArgumentParser(description="Run all Concertron spiders")
+    parser.add_argument('--parallel', type=int, default=settings.getint('CRAWL_MAX_PARALLEL', 1), help="max number of venues crawled at the same time (per process)")
+    parser.add_argument('--processes', type=int, default=settings.getint('CRAWL_PROCESSES', 1), help="number of worker processes to shard the venues over")
+    parser.add_argument('--per-domain', type=int, help="max concurrent requests per domain, overrides CONCURRENT_REQUESTS_PER_DOMAIN")
+    parser.add_argument('--venue', action='append', help="only run the spiders of this venue_id, can be given more than once")
+    parser.add_argument('--kind', action='append', choices=['events', 'tags'], help="only run spiders of this kind, can be given more than once")
+    parser.add_argument('--list', action='store_true', help="list the spiders that would run and exit")
+    parser.add_argument('--rebuild-search', action='store_true', help="rebuild the artist search index from the events in the db before crawling")
+    parser.add_argument('--check-indexes', action='store_true', help="explain the app's queries, report the ones doing a collection scan or an in-memory sort and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for spider in registry.find(args.venue, args.kind):
+            print(f"{spider['name']:<32}{spider['venue_id']:<24}{spider['kind']:<8}{spider['module']}")
+        sys.exit(0)
+    ensure_indexes(get_system_db())
+    if args.check_indexes:
+        scans = collscan_report(get_system_db())
+        for name, stages in scans.items():
+            print(f"{'COLLSCAN' if 'COLLSCAN' in stages else 'SORT'} in {name}: {' <- '.join(stages)}")
+        print(f"{len(scans)} queries scanning a whole collection or sorting in memory")
+        sys.exit(1 if scans else 0)
+    if args.rebuild_search or not get_system_db()[search.collection_name].estimated_document_count(): # Also backfills a fresh install
+        print(f"Artist search index rebuilt with {search.rebuild(get_system_db(), settings.get('MONGODB_COLLECTION', 'events'))} artists")
+    if args.per_domain:
+        runner.settings.set('CONCURRENT_REQUESTS_PER_DOMAIN', args.per_domain, priority='cmdline')
+
+    start = time.monotonic()
+    if args.processes > 1:
+        results, succeeded = run_sharded(args.processes, max(args.parallel, 1), args.per_domain, args.venue, args.kind)
+    else:
+        results = run(max(args.parallel, 1), args.venue, args.kind)
+        succeeded = bool(results) and all(result[2] == 'ok' for result in results) # Same as run_shard, no results is no success
+    print_timings(results, time.monotonic() - start)
+    print_stats(results)
+
+    if succeeded and not args.venue and not args.kind: # last_run means a full refresh, so only move it when every spider (and every shard) made it
+        write_last_run()
     clean_up()
+    bump_data_version() # What the web app's caches and ETags go by, see webapp/facets.py
+    close_clients()
+    sys.exit(0 if succeeded else 1)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The web app and the bot are run from their own folders and import their modules by name, the tests do the same.
+# Both folders have a utils.py: the bot's comes first, the tested web app modules don't import theirs.
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root) # For the shared concertron modules
+sys.path.append(os.path.join(root, 'discord')) # Appended, so discord.py still wins over this folder
+sys.path.append(os.path.join(root, 'webapp'))
@@ -0,0 +1,338 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+
+from pymongo.errors import OperationFailure
+
+from feed import EventFeed
+
+# Just enough of a pymongo collection for the feed: the operators it filters on, sort, limit, a $set update and a change
+# stream that plays back a list of changes, standing in for a replica set
+
+operators = {
+        '$gt': lambda value, operand: value > operand,
+        '$gte': lambda value, operand: value >= operand,
+        '$lt': lambda value, operand: value < operand,
+        '$lte': lambda value, operand: value <= operand,
+        '$in': lambda value, operand: value in operand,
+        }
+
+def matches(document, filter):
+    for key, condition in filter.items():
+        if key == '$and':
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = document.get(key)
+            if value is None or not all(operators[operator](value, operand) for operator, operand in condition.items()):
+                return False
+        elif document.get(key) != condition: # None also matches a missing field, like in MongoDB
+            return False
+    return True
+
+class FakeStream:
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.alive = False
+
+    def try_next(self):
+        if not self.changes:
+            self.alive = False # Ends run_stream, a real stream would wait for more
+            return None
+        return self.changes.pop(0)
+
+class FakeCollection:
+    def __init__(self, documents=()):
+        self.documents = [dict(document) for document in documents]
+        self.replica_set = True
+        self.tokens = set() # Resume tokens still in the oplog
+        self.changes = []
+        self.watches = [] # kwargs of every watch()
+
+    def watch(self, pipeline=None, **kwargs):
+        if not self.replica_set:
+            raise OperationFailure("The $changeStream stage is only supported on replica sets")
+        if 'resume_after' in kwargs and kwargs['resume_after'] not in self.tokens:
+            raise OperationFailure("Resume token was not found")
+        self.watches.append(kwargs)
+        return FakeStream(self.changes)
+
+    def find(self, filter=None, sort=None, limit=0):
+        found = [dict(document) for document in self.documents if matches(document, filter or {})]
+        for field, direction in reversed(sort or []):
+            found.sort(key=lambda document: document[field], reverse=direction < 0)
+        return found[:limit] if limit else found
+
+    def find_one(self, filter):
+        found = self.find(filter)
+        return found[0] if found else None
+
+    def update_one(self, filter, update, upsert=False):
+        for document in self.documents:
+            if matches(document, filter):
+                document.update(update['$set'])
+                return
+        if upsert:
+            self.documents.append({'_id': filter['_id'], **update['$set']})
+
+class FakeDb:
+    def __init__(self, events):
+        self.system = FakeCollection()
+        self.events = FakeCollection(events)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+start = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+
+def event(_id, minutes, **fields):
+    return {'_id': _id, 'last_modified': start + timedelta(minutes=minutes), 'event_type': 'Concert',
+            'date': datetime.now() + timedelta(days=7), 'updates': 'new', **fields}
+
+def make_feed(events, watermark=None):
+    feed = EventFeed(FakeDb(events))
+    feed.settle = 60
+    if watermark:
+        feed.db.system.documents.append({'_id': 'discord', 'last_check': watermark[0], 'last_id': watermark[1]})
+    return feed
+
+def ids(items):
+    return [item['_id'] for item in items]
+
+def test_poll_is_ordered_and_breaks_ties_on_id():
+    feed = make_feed([event('c', 1), event('b', 1), event('a', 2), event('d', 0)], watermark=(start, ''))
+    assert ids(feed.poll()) == ['d', 'b', 'c', 'a']
+
+def test_poll_resumes_within_a_timestamp():
+    feed = make_feed([event('a', 1), event('b', 1), event('c', 1)], watermark=(start + timedelta(minutes=1), 'a'))
+    assert ids(feed.poll()) == ['b', 'c']
+
+def test_poll_once_pages_through_equal_timestamps():
+    feed = make_feed([event(_id, 1) for _id in 'abcde'], watermark=(start, ''))
+    handled = []
+
+    async def handle(item):
+        handled.append(item['_id'])
+
+    assert asyncio.run(feed.poll_once(handle, limit=2)) == 5
+    assert handled == list('abcde')
+    assert feed.watermark() == (start + timedelta(minutes=1), 'e')
+
+def test_watermark_does_not_pass_a_failed_handle():
+    feed = make_feed([event('a', 1), event('b', 2), event('c', 3)], watermark=(start, ''))
+    handled = []
+
+    async def handle(item):
+        if item['_id'] == 'b':
+            raise RuntimeError("Discord is down")
+        handled.append(item['_id'])
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(feed.poll_once(handle))
+    assert handled == ['a']
+    assert feed.watermark() == (start + timedelta(minutes=1), 'a')
+    assert ids(feed.poll()) == ['b', 'c'] # Tried again on the next poll
+
+def test_an_event_that_keeps_failing_is_skipped():
+    feed = make_feed([event('a', 1), event('b', 2)], watermark=(start, ''))
+    feed.max_attempts = 3
+    handled = []
+
+    async def handle(item):
+        if item['_id'] == 'a':
+            raise KeyError('subtitle')
+        handled.append(item['_id'])
+
+    for attempt in range(2):
+        with pytest.raises(KeyError):
+            asyncio.run(feed.poll_once(handle))
+        assert feed.watermark() == (start, '')
+    asyncio.run(feed.poll_once(handle)) # Third failure: skipped
+    assert handled == ['b']
+    assert feed.watermark() == (start + timedelta(minutes=2), 'b')
+    assert feed.failures == {}
+
+def test_polling_survives_a_failing_handler():
+    feed = make_feed([event('a', 1)], watermark=(start, ''))
+    feed.poll_interval = 0
+    polls = []
+
+    async def handle(item):
+        polls.append(item['_id'])
+        if len(polls) == 3:
+            raise asyncio.CancelledError # Stop the loop
+        raise RuntimeError("Discord is down")
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(feed.run_polling(handle))
+    assert polls == ['a', 'a', 'a']
+
+def test_advance_only_moves_forward():
+    feed = make_feed([], watermark=(start + timedelta(minutes=2), 'b'))
+    feed.advance(event('a', 2))
+    feed.advance(event('z', 1))
+    assert feed.watermark() == (start + timedelta(minutes=2), 'b')
+    feed.advance(event('c', 2))
+    assert feed.watermark() == (start + timedelta(minutes=2), 'c')
+
+def test_settle_window_holds_back_recent_events():
+    recent = {'_id': 'new', 'last_modified': datetime.now() - timedelta(seconds=10), 'event_type': 'Concert'}
+    feed = make_feed([event('old', 1), recent], watermark=(start, ''))
+    assert ids(feed.poll()) == ['old']
+    assert ids(feed.poll(settle=0)) == ['old', 'new']
+
+def test_irrelevant_events_still_move_the_watermark():
+    feed = make_feed([event('a', 1, event_type='Art'), event('b', 2, date=datetime(2000, 1, 1))], watermark=(start, ''))
+    handled = []
+
+    async def handle(item):
+        handled.append(item['_id'])
+
+    asyncio.run(feed.poll_once(handle))
+    assert handled == []
+    assert feed.watermark() == (start + timedelta(minutes=2), 'b')
+
+def test_held_progress_is_only_saved_on_commit():
+    feed = make_feed([event('a', 1), event('b', 2)], watermark=(start, ''))
+    feed.hold = True
+    handled = []
+
+    async def handle(item):
+        handled.append(item['_id'])
+
+    asyncio.run(feed.poll_once(handle))
+    assert handled == ['a', 'b']
+    assert feed.state()['last_check'] == start # Nothing saved yet
+    assert feed.poll() == [] # But not fetched again either
+    asyncio.run(feed.commit(feed.take_held()))
+    assert (feed.state()['last_check'], feed.state()['last_id']) == (start + timedelta(minutes=2), 'b')
+
+def test_digest_commits_only_after_sending():
+    from digest import Digest
+    feed = make_feed([event('a', 1), event('b', 2)], watermark=(start, ''))
+    feed.hold = True
+    digest = Digest()
+    sent = []
+
+    async def fail(items):
+        raise RuntimeError("Discord is down")
+
+    async def send(items):
+        sent.extend(item['_id'] for item in items)
+
+    asyncio.run(feed.poll_once(digest.add))
+    with pytest.raises(RuntimeError):
+        asyncio.run(digest.flush(fail, feed))
+    assert feed.state()['last_check'] == start
+    assert set(digest.pending) == {'a', 'b'} # Kept for the next cycle
+    asyncio.run(digest.flush(send, feed))
+    assert sorted(sent) == ['a', 'b']
+    assert (feed.state()['last_check'], feed.state()['last_id']) == (start + timedelta(minutes=2), 'b')
+
+# Change stream
+
+def change(token, item):
+    return {'_id': token, 'operationType': 'update', 'fullDocument': item}
+
+def test_stream_available_only_on_a_replica_set():
+    feed = make_feed([])
+    assert feed.stream_available()
+    feed.collection.replica_set = False
+    assert not feed.stream_available()
+    feed.mode = 'stream'
+    with pytest.raises(OperationFailure):
+        feed.stream_available()
+    feed.mode = 'poll'
+    feed.collection.replica_set = True
+    assert not feed.stream_available()
+
+def test_open_stream_resumes_from_the_saved_token():
+    feed = make_feed([])
+    feed.collection.tokens.add('t1')
+    feed.save_token('t1')
+    stream, resumed = feed.open_stream()
+    assert resumed
+    assert feed.collection.watches[-1]['resume_after'] == 't1'
+
+def test_open_stream_starts_over_when_the_token_is_gone():
+    feed = make_feed([])
+    feed.save_token('expired')
+    stream, resumed = feed.open_stream()
+    assert not resumed
+    assert 'resume_after' not in feed.collection.watches[-1]
+
+def test_new_stream_catches_up_first():
+    feed = make_feed([event('missed', 1)], watermark=(start, ''))
+    feed.collection.changes = [change('t1', event('a', 2)), change('t2', event('b', 3))]
+    handled = []
+
+    async def handle(item):
+        handled.append(item['_id'])
+
+    asyncio.run(feed.run_stream(handle))
+    assert handled == ['missed', 'a', 'b']
+    assert feed.state()['resume_token'] == 't2'
+    assert feed.watermark() == (start + timedelta(minutes=3), 'b')
+
+def test_resumed_stream_does_not_poll():
+    feed = make_feed([event('old', 1)], watermark=(start, ''))
+    feed.collection.tokens.add('t1')
+    feed.save_token('t1')
+    feed.collection.changes = [change('t2', event('a', 2))]
+    handled = []
+
+    async def handle(item):
+        handled.append(item['_id'])
+
+    asyncio.run(feed.run_stream(handle))
+    assert handled == ['a']
+    assert feed.state()['resume_token'] == 't2'
+
+def test_stream_skips_irrelevant_changes_but_saves_their_token():
+    feed = make_feed([], watermark=(start, ''))
+    feed.collection.changes = [change('t1', event('art', 1, event_type='Art')), change('t2', None)] # None: deleted since
+    handled = []
+
+    async def handle(item):
+        handled.append(item['_id'])
+
+    asyncio.run(feed.run_stream(handle))
+    assert handled == []
+    assert feed.state()['resume_token'] == 't2'
+
+def test_stream_token_does_not_pass_a_failed_handle():
+    feed = make_feed([], watermark=(start, ''))
+    feed.collection.changes = [change('t1', event('a', 1)), change('t2', event('b', 2))]
+
+    async def handle(item):
+        if item['_id'] == 'b':
+            raise RuntimeError("Discord is down")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(feed.run_stream(handle))
+    assert feed.state()['resume_token'] == 't1' # Reopening resumes right before b
+    assert feed.watermark() == (start + timedelta(minutes=1), 'a')
+
+def test_held_stream_progress_waits_for_commit():
+    feed = make_feed([], watermark=(start, ''))
+    feed.hold = True
+    feed.collection.tokens.add('t0')
+    feed.save_token('t0')
+    feed.collection.changes = [change('t1', event('a', 1))]
+
+    async def handle(item):
+        pass
+
+    asyncio.run(feed.run_stream(handle))
+    assert feed.state()['resume_token'] == 't0'
+    asyncio.run(feed.commit(feed.take_held()))
+    assert feed.state()['resume_token'] == 't1'
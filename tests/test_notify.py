@@ -0,0 +1,127 @@
+import asyncio
+import time
+import pytest
+
+import notify
+
+# A fake client: destinations fail with the given errors first, then send. Messages can be made to fail their reaction.
+
+class HTTPError(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(status)
+        self.status = status
+        self.retry_after = retry_after
+
+class Message:
+    def __init__(self, fail_reaction=False):
+        self.fail_reaction = fail_reaction
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        if self.fail_reaction:
+            raise HTTPError(503)
+        self.reactions.append(emoji)
+
+class Destination:
+    def __init__(self, id, errors=(), fail_reaction=False):
+        self.id = id
+        self.errors = list(errors)
+        self.fail_reaction = fail_reaction
+        self.sent = [] # kwargs of every send that went through
+        self.attempts = 0
+
+    async def send(self, **kwargs):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(kwargs)
+        return Message(self.fail_reaction)
+
+@pytest.fixture
+def sleeps(monkeypatch): # Delays the dispatcher backs off with, without actually waiting
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(notify.asyncio, 'sleep', sleep)
+    return delays
+
+def dispatch(destination, retries=3, backoff=1, **kwargs):
+    async def main():
+        dispatcher = notify.Dispatcher(make_file=lambda fp, filename: (fp, filename), retries=retries, backoff=backoff, global_rate=1000, route_rate=1000, route_per=1)
+        future = await dispatcher.submit(destination, **kwargs)
+        await dispatcher.stop()
+        return await future, dispatcher.report()
+    return asyncio.run(main())
+
+def test_retries_with_exponential_backoff(sleeps):
+    destination = Destination(1, errors=[HTTPError(500), HTTPError(502), HTTPError(503)])
+    message, stats = dispatch(destination, content='hi')
+    assert message is not None
+    assert sleeps == [1, 2, 4]
+    assert (stats['sent'], stats['retried'], stats['failed']) == (1, 3, 0)
+
+def test_gives_up_after_the_retries(sleeps):
+    destination = Destination(1, errors=[HTTPError(500)] * 4)
+    message, stats = dispatch(destination, retries=2, content='hi')
+    assert message is None
+    assert destination.attempts == 3
+    assert (stats['sent'], stats['failed']) == (0, 1)
+
+@pytest.mark.parametrize('status', [403, 404])
+def test_closed_dms_are_not_retried(sleeps, status):
+    destination = Destination(1, errors=[HTTPError(status)])
+    message, stats = dispatch(destination, content='hi')
+    assert message is None
+    assert destination.attempts == 1
+    assert sleeps == []
+    assert (stats['failed'], stats['retried']) == (1, 0)
+
+def test_rate_limited_waits_for_retry_after(sleeps):
+    destination = Destination(1, errors=[HTTPError(429, retry_after=7.5), HTTPError(429, retry_after=0.5)])
+    message, stats = dispatch(destination, content='hi')
+    assert message is not None
+    assert sleeps == [7.5, 2] # retry_after, unless the backoff is longer
+    assert stats['rate_limited'] == 2
+
+def test_failed_reaction_does_not_send_again(sleeps):
+    destination = Destination(1, fail_reaction=True)
+    message, stats = dispatch(destination, content='hi', reaction='❤️')
+    assert message is not None
+    assert len(destination.sent) == 1
+    assert (stats['sent'], stats['failed'], stats['reaction_failed']) == (1, 0, 1)
+
+def test_reaction_is_added(sleeps):
+    destination = Destination(1)
+    message, stats = dispatch(destination, content='hi', reaction='❤️')
+    assert message.reactions == ['❤️']
+
+def test_every_attempt_gets_fresh_files(sleeps):
+    destination = Destination(1, errors=[HTTPError(500)])
+    dispatch(destination, attachments=[(b'image', 'image.webp')])
+    fp, filename = destination.sent[0]['file']
+    assert (fp.read(), filename) == (b'image', 'image.webp') # Not read empty by the failed attempt
+
+def test_wait_raises_when_a_required_message_fails():
+    async def main():
+        dispatcher = notify.Dispatcher(make_file=None, retries=0, backoff=0)
+        closed = await dispatcher.submit(Destination(1, errors=[HTTPError(403)]), content='hi')
+        home = await dispatcher.submit(Destination(2), content='hi')
+        await notify.wait([closed], required=[home]) # A closed DM is fine
+        home = await dispatcher.submit(Destination(2, errors=[HTTPError(403)]), content='hi')
+        with pytest.raises(notify.DeliveryError):
+            await notify.wait([], required=[home])
+        await dispatcher.stop()
+    asyncio.run(main())
+
+def test_token_bucket_limits_the_rate():
+    async def main():
+        bucket = notify.TokenBucket(2, 0.2)
+        start = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - start
+    assert 0.08 < asyncio.run(main()) < 0.5 # The third waits for a token, 0.1 s
@@ -0,0 +1,104 @@
+import asyncio
+import copy
+import itertools
+import threading
+import pytest
+
+from subscriptions import SubscriptionIndex, sendlist_query
+import users
+
+class FakeUsers: # discord_users, with what the index and users.update_user use
+    def __init__(self, profiles):
+        self.profiles = {profile['_id']: copy.deepcopy(profile) for profile in profiles}
+
+    def find(self, filter, projection):
+        return [copy.deepcopy(profile) for profile in self.profiles.values()]
+
+    def update_one(self, filter, update):
+        profile = self.profiles.setdefault(filter['_id'], {'_id': filter['_id']})
+        for field, value in update['$addToSet'].items():
+            values = profile.setdefault(field, [])
+            values.extend(v for v in value['$each'] if v not in values)
+
+class FakeDb:
+    def __init__(self, profiles=()):
+        self.discord_users = FakeUsers(profiles)
+
+profiles = [
+        {'_id': 1, 'artists': ['Boygenius', 'Wilco'], 'tags': ['Indie'], 'events': ['nl_013-1']},
+        {'_id': 2, 'artists': ['Wilco'], 'tags': [], 'events': []},
+        {'_id': 3, 'artists': [], 'tags': ['Indie', 'Folk'], 'events': ['nl_013-2']},
+        {'_id': 4}, # Made before a field existed
+        ]
+
+def legacy_sendlist(artists=None, tags=None, events=None): # What create_sendlist used to ask MongoDB: an $or of $in's
+    query = {'artists': artists, 'tags': tags, 'events': events}
+    return {profile['_id'] for profile in profiles
+            if any(set(values) & set(profile.get(field) or []) for field, values in query.items() if values)}
+
+def built_index():
+    index = SubscriptionIndex(FakeDb(profiles), ttl=600)
+    asyncio.run(index.ensure())
+    return index
+
+values = {'artists': [None, [], ['Wilco'], ['Boygenius', 'Nobody'], ['Nobody']],
+          'tags': [None, ['Indie'], ['Folk', 'Jazz']],
+          'events': [None, ['nl_013-1'], ['nl_013-9']]}
+
+@pytest.mark.parametrize('artists,tags,events', list(itertools.product(*values.values())))
+def test_lookup_matches_the_legacy_query(artists, tags, events):
+    assert built_index().lookup(artists, tags, events) == legacy_sendlist(artists, tags, events)
+
+def test_resolve_per_event():
+    index = SubscriptionIndex(FakeDb(profiles), ttl=600)
+    queries = {'new': sendlist_query({'_id': 'nl_013-3', 'updates': 'new', 'lineup': ['Wilco'], 'tags': ['Folk']}),
+               'updated': sendlist_query({'_id': 'nl_013-2', 'updates': ['status'], 'lineup': ['Nobody'], 'tags': ['Indie']})}
+    assert asyncio.run(index.resolve(queries)) == {'new': {1, 2, 3}, 'updated': {3}} # Updates go by event, not by tag
+
+def test_no_sendlist_without_changes():
+    assert sendlist_query({'_id': 'nl_013-1', 'updates': []}) is None
+
+def test_add_is_found_right_away():
+    index = built_index()
+    index.add(5, artists=['Nobody'], events=['nl_013-9'])
+    assert index.lookup(artists=['Nobody']) == {5}
+    assert index.lookup(events=['nl_013-9']) == {5}
+
+def test_adds_during_a_rebuild_are_kept():
+    db = FakeDb(profiles)
+    index = SubscriptionIndex(db, ttl=600)
+    reading = threading.Event()
+    added = threading.Event()
+    build = index.build
+
+    def slow_build(): # Reads discord_users before the add below was written
+        result = build()
+        reading.set()
+        added.wait(5)
+        return result
+
+    index.build = slow_build
+
+    async def main():
+        rebuild = asyncio.create_task(index.ensure())
+        await asyncio.to_thread(reading.wait, 5)
+        index.add(5, artists=['Nobody'])
+        added.set()
+        await rebuild
+
+    asyncio.run(main())
+    assert index.lookup(artists=['Nobody']) == {5}
+    assert index.lookup(artists=['Wilco']) == {1, 2}
+    assert index.pending is None
+
+@pytest.mark.parametrize('events', [[], 'nl_013-7', ['nl_013-7', 'nl_013-8']])
+def test_update_user_events(monkeypatch, events):
+    db = FakeDb(profiles)
+    monkeypatch.setattr(users, 'db', db)
+    monkeypatch.setattr(users, 'subscriptions', SubscriptionIndex(db, ttl=600))
+    asyncio.run(users.update_user(2, events=events, artists=['Nobody'])) # events=[] used to raise unhashable type: 'list'
+    expected = [events] if isinstance(events, str) else events
+    assert db.discord_users.profiles[2]['events'] == expected # Ids, not a list stored as one element
+    assert users.subscriptions.lookup(artists=['Nobody']) == {2}
+    for _id in expected:
+        assert users.subscriptions.lookup(events=[_id]) == {2}
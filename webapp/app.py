@@ -1,80 +1,147 @@
-from flask import Flask, render_template, request, send_from_directory, jsonify, session
-from pymongo import MongoClient
+from flask import Flask, render_template, request, send_from_directory, jsonify, session, url_for
+from werkzeug.datastructures import MultiDict
 from datetime import datetime
+import gzip
+import hashlib
 import secrets
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # For the shared concertron modules
+from concertron.db import get_db, get_setting, pool_stats, ensure_indexes
+from concertron.images import resize_webp, size_path
+from facets import FacetCache
+import query
+
+try:
+    import brotli # Optional, without it the API is only gzipped
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
-# MongoDB connection
-client = MongoClient('mongodb://concertron-mongodb:27017/')
-db = client['concertron']  # Change this to your database name
+# MongoDB connection, configured in concertron/settings.py
+db = get_db()
 collection = db['events']  # Change this to your collection name
+ensure_indexes(db)
 
 app.secret_key = secrets.token_hex(16)
-tag_list = db.events.distinct('tags', filter={'$or': [{'event_type': 'Concert'}, {'event_type': 'Club'}, {'event_type': 'Festival'}]})
+
+page_size = 50
+projection = {field: 1 for field in ['date', 'title', 'support', 'status', 'url', 'subtitle', 'tags', 'location']} # Only what index.html shows
+facet_cache = FacetCache(db, ttl=get_setting('FACETS_TTL', 30))
+
+def parse_cursor(cursor): # "<iso date>|<_id>" of the last event on the previous page
+    try:
+        date, _id = cursor.split('|', 1)
+        return datetime.fromisoformat(date), _id
+    except (AttributeError, ValueError):
+        return None
+
+def fetch_page(filter, cursor=None): # Keyset pagination on (date, _id), so every page costs the same however far in you are
+    after = parse_cursor(cursor)
+    if after:
+        filter = {'$and': [filter, {'$or': [{'date': {'$gt': after[0]}}, {'date': after[0], '_id': {'$gt': after[1]}}]}]}
+    data = list(collection.find(filter=filter, projection=projection, sort=[('date', 1), ('_id', 1)], limit=page_size + 1))
+    next_cursor = None
+    if len(data) > page_size:
+        data = data[:page_size]
+        next_cursor = f"{data[-1]['date'].isoformat()}|{data[-1]['_id']}"
+    return data, next_cursor
 
 @app.route('/')
 def index():
     # Fetch data from MongoDB
-    data = list(collection.find(filter={
-        '$or': [{'event_type': 'Concert'}, {'event_type': 'Club'}, {'event_type': 'Festival'}],
-        'date': {'$gt': datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)}
-        }, sort = {
-            'date': 1
-            }))  # Fetch all documents
-    return render_template('index.html', data=data, collection=collection)
+    data, next_cursor = fetch_page(query.build(query.parse(MultiDict())), request.args.get('after'))
+    next_url = url_for('index', after=next_cursor) if next_cursor else None
+    return render_template('index.html', data=data, facets=facet_cache.get('events'), next_url=next_url)
 
 
-@app.route('/filter', methods=['POST'])
+@app.route('/filter', methods=['GET', 'POST']) # GET for the next pages, the form itself posts
 def filter_data():
-    print(request.form.get('date'), str(type(request.form.get('date'))))
-    filter = {
-            '$or': [{'event_type': 'Concert'}, {'event_type': 'Club'}, {'event_type': 'Festival'}],
-            'date': {'$gt': datetime.now()}
-            }
-    for key, value in request.form.items():
-        if key == 'status':
-            if 'status' not in filter.keys():
-                checked = request.form.getlist('status')
-                if len(checked) == 1:
-                    filter['status'] = checked[0]
-                else:
-                    filter['$or'] = [{'status': status} for status in checked]
-        elif key == 'date':
-            if value:
-                filter['date'] = {'$gt': datetime.fromisoformat(value).replace(hour=0, minute=0, second=0, microsecond=0)}
-            else:
-                filter['date'] = {'$gt': datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)}
-        elif key == 'lineup':
-            if value:
-                filter['lineup'] = {'$regex': value, '$options': 'i'}
-        elif value != "NO_FILTER":
-            filter[key] = value
-
-    data = list(collection.find(filter=filter, sort={'date': 1}))
-    return render_template('index.html', data=data, collection=collection)
+    data, next_cursor = fetch_page(query.build(query.parse(request.values), db), request.values.get('after'))
+    next_url = None
+    if next_cursor:
+        args = request.values.to_dict(flat=False)
+        args['after'] = next_cursor
+        next_url = url_for('filter_data', **args)
+    return render_template('index.html', data=data, facets=facet_cache.get('events'), next_url=next_url)
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    # Same filters as /filter plus the after cursor, as query parameters. Results only change when the scraper ran (or the
+    # day changed, past events drop off), so the ETag is made from the events version, the date and the filter spec.
+    spec = query.parse(request.args) # Canonical, so the same filters in another order or spelling get the same ETag
+    stamp = repr((str(facet_cache.version_stamp('events')), datetime.now().date().isoformat(), query.key(spec), request.args.get('after')))
+    etag = hashlib.sha1(stamp.encode('utf-8')).hexdigest()
+    if any(request.if_none_match.contains(etag + suffix) for suffix in ('', '-gzip', '-br')):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    data, next_cursor = fetch_page(query.build(spec, db), request.args.get('after'))
+    for entry in data:
+        entry['date'] = entry['date'].isoformat()
+    response = jsonify(events=data, next=next_cursor)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' # Cache it, but always revalidate
+    return response
+
+@app.after_request
+def compress(response): # Only the API, pages and images are left to whatever is in front of the app
+    if not request.path.startswith('/api/') or response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    accepted = request.accept_encodings
+    if brotli and accepted['br']:
+        encoding, body = 'br', brotli.compress(response.get_data())
+    elif accepted['gzip']:
+        encoding, body = 'gzip', gzip.compress(response.get_data(), compresslevel=6)
+    else:
+        return response
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak) # A strong ETag belongs to one exact body
+    return response
 
 @app.route('/images/<path:filename>', methods=['GET'])
 def serve_image(filename):
     img_dir = '../img/'
+    size = request.args.get('size')
+    sizes = get_setting('IMAGES_SIZES', {})
+    if size in sizes and filename.endswith('.webp') and '/' not in filename:
+        name = filename[:-len('.webp')]
+        sized = size_path(img_dir, name, size)
+        if not os.path.exists(sized) and os.path.exists(os.path.join(img_dir, filename)): # Made once, on first request
+            resize_webp(os.path.join(img_dir, filename), sized, sizes[size], get_setting('IMAGES_WEBP_QUALITY', 80), get_setting('IMAGES_WEBP_METHOD', 4))
+        if os.path.exists(sized):
+            return send_from_directory(os.path.dirname(sized), os.path.basename(sized), max_age=86400)
     return send_from_directory(img_dir, filename)
 
+@app.route('/stats/mongodb', methods=['GET'])
+def mongodb_stats():
+    return jsonify(pool_stats.snapshot())
+
+def next_untagged(index): # Index of the first tag from index on that has not been tagged yet
+    tag_list = facet_cache.get('events')['tags']
+    tagged = facet_cache.get('tags')['tagged']
+    while tag_list[index] in tagged:
+        index += 1
+    return index
+
 @app.route('/tagger', methods=['GET'])
 def tagger():
-    session['list_index'] = 0
-    while db.tags.find_one({'_id': tag_list[session['list_index']]}) is not None:
-        # print(session['list_index'])
-        # print(db.tags.find_one({'_id': tag_list[session['list_index']]}))
-        session['list_index'] += 1
-    tag = tag_list[session['list_index']]
-    meta_tags = db.tags.distinct('meta_tags')
-    genre_tags = db.tags.distinct('genre_tags')
-    special_tags = db.tags.distinct('special_tags')
-    return render_template('tagger.html', tag=tag, metas=meta_tags, genres=genre_tags, specials=special_tags)
+    session['list_index'] = next_untagged(0)
+    tag = facet_cache.get('events')['tags'][session['list_index']]
+    tags = facet_cache.get('tags')
+    return render_template('tagger.html', tag=tag, metas=tags['meta_tags'], genres=tags['genre_tags'], specials=tags['special_tags'])
 
 @app.route('/tagger/submit', methods=['POST'])
 def submit():
     form = request.form
+    tag_list = facet_cache.get('events')['tags']
     new_meta_tags = []
     new_genre_tags = []
     new_special_tags = []
@@ -98,16 +165,12 @@ def submit():
         'genre_tags': new_genre_tags,
         'special_tags': new_special_tags
         })
+    facet_cache.bump('tags')
 
-
-    meta_tags = db.tags.distinct('meta_tags')
-    genre_tags = db.tags.distinct('genre_tags')
-    special_tags = db.tags.distinct('special_tags')
-    session['list_index'] += 1
-    while db.tags.find_one({'_id': tag_list[session['list_index']]}) is not None:
-        session['list_index'] += 1
+    tags = facet_cache.get('tags')
+    session['list_index'] = next_untagged(session['list_index'] + 1)
     tag = tag_list[session['list_index']]
-    return jsonify(tag=tag, metas=meta_tags, genres=genre_tags, specials=special_tags)
+    return jsonify(tag=tag, metas=tags['meta_tags'], genres=tags['genre_tags'], specials=tags['special_tags'])
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True)
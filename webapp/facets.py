@@ -0,0 +1,54 @@
+import threading
+import time
+
+# Lists the web app would otherwise get with a distinct over a whole collection on every request:
+# - 'events': the filter form (artists, venues, statuses) and the tags for the tagger. Changes when the scraper runs,
+#   run_spiders.py bumps its version at the end of every run (not last_run, that only moves on full successful runs).
+# - 'tags': what has been tagged so far. Changes on tagger submits, which bump a version in db.system with bump('tags').
+# Versions are only checked once every ttl seconds, so most requests don't touch MongoDB at all.
+
+event_types = {'$or': [{'event_type': 'Concert'}, {'event_type': 'Club'}, {'event_type': 'Festival'}]}
+
+class FacetCache:
+    def __init__(self, db, ttl=30, collection='events'):
+        self.db = db
+        self.ttl = ttl
+        self.collection = collection
+        self.lock = threading.Lock()
+        self.entries = {} # group: {'version', 'checked', 'values'}
+
+    def version(self, group):
+        stamp = self.db.system.find_one({'_id': group}, {'version': 1})
+        return stamp.get('version', 0) if stamp else 0
+
+    def compute(self, group):
+        if group == 'events':
+            values = {field: sorted(value for value in self.db[self.collection].distinct(field) if value) for field in ('lineup', 'venue_id', 'status')}
+            values['tags'] = sorted(self.db[self.collection].distinct('tags', filter=event_types)) # Sorted, the tagger walks it by index
+            return values
+        values = {field: self.db.tags.distinct(field) for field in ('meta_tags', 'genre_tags', 'special_tags')}
+        values['tagged'] = set(self.db.tags.distinct('_id'))
+        return values
+
+    def get(self, group='events'):
+        with self.lock:
+            entry = self.entries.get(group)
+            now = time.monotonic()
+            if entry and now - entry['checked'] < self.ttl:
+                return entry['values']
+            version = self.version(group)
+            if not entry or entry['version'] != version:
+                entry = {'version': version, 'values': self.compute(group)}
+                self.entries[group] = entry
+            entry['checked'] = now
+            return entry['values']
+
+    def version_stamp(self, group='events'): # Version of the cached values, at most ttl seconds old
+        self.get(group)
+        entry = self.entries.get(group) # Could just have been bumped
+        return entry['version'] if entry else None
+
+    def bump(self, group): # After writing to what a group is computed from. Other processes pick it up within ttl seconds
+        self.db.system.update_one({'_id': group}, {'$inc': {'version': 1}}, upsert=True)
+        with self.lock:
+            self.entries.pop(group, None)
@@ -0,0 +1,104 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # For the shared concertron modules
+from concertron import search
+from concertron.db import plan_stages
+
+# Turns the filter form / API query parameters into a Mongo filter. Only the fields below are accepted, everything else is
+# ignored. A FilterSpec is immutable and hashable and two requests meaning the same thing get the same spec (and so the same
+# filter), which makes it usable as a cache key. Every field becomes an $in (or a date range), so the event_type+date+_id index
+# always applies.
+
+event_types = ('Concert', 'Club', 'Festival') # What the web app shows by default
+allowed_event_types = event_types + ('Art', 'Comedy', 'Knowledge')
+
+FilterSpec = namedtuple('FilterSpec', ['event_types', 'venues', 'statuses', 'tags', 'date_from', 'date_to', 'artist'])
+
+def parse_date(value):
+    try:
+        return datetime.fromisoformat(value).replace(hour=0, minute=0, second=0, microsecond=0)
+    except (TypeError, ValueError):
+        return None
+
+def values_of(values, key): # Non-empty values of a multi-valued form field, without the form's "All" option
+    return frozenset(value for value in values.getlist(key) if value and value != 'NO_FILTER')
+
+def parse(values, today=None):
+    today = today or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    types = values_of(values, 'event_type') & set(allowed_event_types)
+    artist = search.normalize(values.get('lineup') or '')
+    return FilterSpec(
+            event_types=types or frozenset(event_types),
+            venues=values_of(values, 'venue_id'),
+            statuses=values_of(values, 'status'),
+            tags=values_of(values, 'tags'),
+            date_from=max(parse_date(values.get('date')) or today, today), # Never the past, that gets cleaned up anyway
+            date_to=parse_date(values.get('date_to')),
+            artist=artist or None,
+            )
+
+def key(spec): # Same as the spec, but with sorted tuples instead of sets, so its repr is the same in every process (for ETags)
+    return tuple(tuple(sorted(value)) if isinstance(value, frozenset) else value for value in spec)
+
+def build(spec, db=None): # db is needed for artist searches
+    filter = {
+            'event_type': {'$in': sorted(spec.event_types)},
+            'date': {'$gte': spec.date_from},
+            }
+    if spec.date_to:
+        filter['date']['$lt'] = spec.date_to + timedelta(days=1) # date_to is inclusive
+    if spec.venues:
+        filter['venue_id'] = {'$in': sorted(spec.venues)}
+    if spec.statuses:
+        filter['status'] = {'$in': sorted(spec.statuses)}
+    if spec.tags:
+        filter['tags'] = {'$in': sorted(spec.tags)}
+    if spec.artist:
+        filter['_id'] = {'$in': sorted(search.find_event_ids(db, spec.artist))}
+    return filter
+
+def legacy_filter(values): # What /filter used to build, only kept to compare plans against
+    filter = {'$or': [{'event_type': 'Concert'}, {'event_type': 'Club'}, {'event_type': 'Festival'}], 'date': {'$gt': datetime.now()}}
+    for key, value in values.items():
+        if key == 'status':
+            checked = values.getlist('status')
+            if len(checked) == 1:
+                filter['status'] = checked[0]
+            else:
+                filter['$or'] = [{'status': status} for status in checked]
+        elif key == 'date':
+            if value:
+                filter['date'] = {'$gt': datetime.fromisoformat(value)}
+        elif key == 'lineup':
+            if value:
+                filter['lineup'] = {'$regex': value, '$options': 'i'}
+        elif value != 'NO_FILTER':
+            filter[key] = value
+    return filter
+
+def compare_plans(db, values, collection='events'): # Winning plan, documents examined and time for the old and the compiled filter
+    results = {}
+    for name, filter in (('legacy', legacy_filter(values)), ('compiled', build(parse(values), db))):
+        start = time.monotonic()
+        explain = db[collection].find(filter).sort([('date', 1), ('_id', 1)]).explain()
+        stats = explain.get('executionStats', {})
+        results[name] = {
+                'stages': plan_stages(explain['queryPlanner']['winningPlan']),
+                'docs_examined': stats.get('totalDocsExamined'),
+                'keys_examined': stats.get('totalKeysExamined'),
+                'ms': (time.monotonic() - start) * 1000,
+                }
+    return results
+
+if __name__ == '__main__': # python query.py [key=value ...], e.g. python query.py status=SALE_LIVE status=FEW_TICKETS venue_id=nl_013
+    from werkzeug.datastructures import MultiDict
+    from concertron.db import get_db
+    values = MultiDict([argument.split('=', 1) for argument in sys.argv[1:]])
+    print(parse(values))
+    print(build(parse(values), get_db()))
+    for name, result in compare_plans(get_db(), values).items():
+        print(f"{name:<10}{' <- '.join(result['stages']):<40}docs {result['docs_examined']}, keys {result['keys_examined']}, {result['ms']:.1f} ms")